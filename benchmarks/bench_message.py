@@ -0,0 +1,68 @@
+"""Per message CPU and memory of nice_message and its render paths.
+Run from the repo root: python -m benchmarks.bench_message [count]"""
+import atexit
+import os
+import shutil
+import sys
+import timeit
+import tracemalloc
+
+os.environ.setdefault("SYSLOG", "bench.log")
+os.environ.setdefault("DATE_FORMAT", "%Y-%m-%d %H:%M:%S %z")
+os.environ.setdefault("MAX_LOG_SIZE_MB", "8")
+
+from benchmarks.fixtures import Fixtures, sandbox  # noqa: E402
+
+atexit.register(shutil.rmtree, sandbox(), True)
+
+from kiroku.util.message import nice_message  # noqa: E402
+
+
+PATHS = {
+    "construct": lambda args: nice_message(*args),
+    "recordise": lambda args: nice_message(*args).recordise(),
+    "stringise": lambda args: nice_message(*args).stringise(),
+    "stringise_compact": lambda args: nice_message(*args).stringise_compact(),
+    "jsonise": lambda args: nice_message(*args).jsonise(),
+}
+
+
+def bench_cpu(messages: list[tuple], repeat: int = 5) -> dict[str, float]:
+    """Best microseconds per message for each path"""
+    results = {}
+    for name, path in PATHS.items():
+        timer = timeit.Timer(lambda: [path(args) for args in messages])
+        best = min(timer.repeat(repeat=repeat, number=1))
+        results[name] = best / len(messages) * 1_000_000
+    return results
+
+
+def bench_memory(messages: list[tuple]) -> dict[str, float]:
+    """Bytes per message still allocated after each path, keeping what it returns"""
+    results = {}
+    tracemalloc.start()
+    for name, path in PATHS.items():
+        before = tracemalloc.get_traced_memory()[0]
+        kept = [path(args) for args in messages]
+        results[name] = (tracemalloc.get_traced_memory()[0] - before) / len(kept)
+        del kept
+    tracemalloc.stop()
+    return results
+
+
+def main(count: int = 10_000):
+    messages = Fixtures(count).args()
+    print(f"{count} messages")
+    print("CPU, us per message")
+    for name, value in bench_cpu(messages).items():
+        print(f"\t{name:18} {value:8.2f}")
+    print("Memory, bytes per message")
+    for name, value in bench_memory(messages).items():
+        print(f"\t{name:18} {value:8.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
+
+
+# MIT APasz
@@ -0,0 +1,263 @@
+"""Throughput of the message rendering and archive paths, saved as JSON to compare between versions.
+Run from the repo root: python -m benchmarks.bench_suite [--count N] [--out FILE] [--compare FILE]"""
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import time
+import timeit
+from collections.abc import Callable
+from datetime import datetime, timezone
+from pathlib import Path as Pathy
+
+os.environ.setdefault("SYSLOG", "bench.log")
+os.environ.setdefault("DATE_FORMAT", "%Y-%m-%d %H:%M:%S %z")
+os.environ.setdefault("MAX_LOG_SIZE_MB", "8")
+
+from benchmarks.fixtures import Fixtures, sandbox  # noqa: E402
+
+FOLDER = sandbox()
+atexit.register(shutil.rmtree, FOLDER, True)
+
+import kiroku  # noqa: E402
+from kiroku.extensions.event import event_log  # noqa: E402
+from kiroku.store import Store  # noqa: E402
+from kiroku.util.database import Message_DB  # noqa: E402
+from kiroku.util.edits import Update_Coalescer  # noqa: E402
+from kiroku.util.file import bytes_to_human  # noqa: E402
+from kiroku.util.jobs import Job_Manager, Retrieve_Job  # noqa: E402
+from kiroku.util.logs import Log_Registry  # noqa: E402
+from kiroku.util.message import get_logger, nice_message  # noqa: E402
+from kiroku.util.mirror import Attachment_Mirror  # noqa: E402
+from kiroku.util.render import RENDERERS, find_link_expiry  # noqa: E402
+from kiroku.util.writer import Archive_Writer  # noqa: E402
+
+RESULTS = Pathy(__file__).parent.joinpath("results")
+
+LOWER = "us"
+"Microseconds per operation, lower is better"
+HIGHER = "msg/s"
+"Messages per second, higher is better"
+
+
+def best_us(func: Callable[[], object], ops: int, repeat: int) -> float:
+    """Best microseconds per operation, func doing ops operations"""
+    return min(timeit.repeat(func, repeat=repeat, number=1)) / ops * 1_000_000
+
+
+def bench_message(fix: Fixtures, repeat: int) -> dict[str, float]:
+    """nice_message and its renders, each from a fresh nice_message as the listeners make them"""
+    args = fix.args()
+    paths = {
+        "nice_message": lambda a: nice_message(*a),
+        "recordise": lambda a: nice_message(*a).recordise(),
+        "stringise": lambda a: nice_message(*a).stringise(),
+        "stringise_compact": lambda a: nice_message(*a).stringise_compact(),
+        "jsonise": lambda a: nice_message(*a).jsonise(),
+    }
+    return {
+        name: best_us(lambda: [path(a) for a in args], len(args), repeat)
+        for name, path in paths.items()
+    }
+
+
+def bench_helpers(fix: Fixtures, repeat: int) -> dict[str, float]:
+    sizes = [7**power for power in range(1, 25)]
+    links = [attach.url for message in fix.messages for attach in message.attachments]
+    messages = [nice_message(*a) for a in fix.args()]
+    Store.logs = Log_Registry()
+    return {
+        "bytes_to_human": best_us(
+            lambda: [bytes_to_human(size) for size in sizes], len(sizes), repeat
+        ),
+        "find_link_expiry": best_us(
+            lambda: [find_link_expiry(link) for link in links], len(links), repeat
+        ),
+        "get_logger": best_us(
+            lambda: [
+                get_logger(mess=mess, chan_name="bench", guild_name="Bench")
+                for mess in messages
+            ],
+            len(messages),
+            repeat,
+        ),
+    }
+
+
+async def _event_log(fix: Fixtures, run: int) -> tuple[float, float]:
+    """Seconds handling the events, and until their records were on disk"""
+    Store.database = Message_DB(FOLDER.joinpath(f"event_{run}.sqlite3"))
+    Store.logs = Log_Registry()
+    Store.writer = Archive_Writer(logs=Store.logs, database=Store.database)
+    Store.edits = Update_Coalescer(emit=Store.writer.put)
+    Store.mirror = Attachment_Mirror()
+    events = [fix.event(message) for message in fix.messages]
+
+    Store.writer.start()
+    start = time.perf_counter()
+    for event in events:
+        await event_log(event, live=True)
+    handled = time.perf_counter() - start
+    await asyncio.to_thread(Store.writer.stop)
+    written = time.perf_counter() - start
+    Store.database.close()
+    return handled, written
+
+
+def bench_event_log(fix: Fixtures, repeat: int) -> dict[str, float]:
+    """event_log per event, and the whole way to disk through the writer thread and database"""
+    runs = [asyncio.run(_event_log(fix, run)) for run in range(repeat)]
+    count = len(fix.messages)
+    return {
+        "event_log": min(handled for handled, _ in runs) / count * 1_000_000,
+        "event_log_to_disk": count / min(written for _, written in runs),
+    }
+
+
+async def _retrieve(fix: Fixtures, fmt: str, run: int) -> float:
+    """Seconds a retrieve job takes over the whole channel"""
+    Store.database = Message_DB(FOLDER.joinpath(f"retrieve_{fmt}_{run}.sqlite3"))
+    Store.mirror = Attachment_Mirror()
+    jobs = Job_Manager(folder=FOLDER.joinpath(f"jobs_{fmt}_{run}"))
+    jobs.start(fix.app())
+    job = Retrieve_Job(
+        job_id=f"{fmt}{run}",
+        guild_id=int(fix.guild.id),
+        channel_id=int(fix.channel.id),
+        requester_id=0,
+        fmt=fmt,
+        file=str(FOLDER.joinpath(f"retrieve_{run}{RENDERERS[fmt].ext}")),
+    )
+    start = time.perf_counter()
+    jobs.submit(job)
+    while not job.finished:
+        await asyncio.sleep(0.001)
+    took = time.perf_counter() - start
+    await jobs.stop()
+    Store.database.close()
+    if job.state != "DONE":
+        raise RuntimeError(f"Retrieve {fmt} {job.state}: {job.error}")
+    return took
+
+
+def retrieve_name(fmt: str) -> str:
+    return "retrieve_" + re.sub(r"\W+", "_", fmt.lower()).strip("_")
+
+
+def bench_retrieve(fix: Fixtures, repeat: int) -> dict[str, float]:
+    """A retrieve job against paged history, in each format"""
+    count = len(fix.messages)
+    return {
+        retrieve_name(fmt): count
+        / min(asyncio.run(_retrieve(fix, fmt, run)) for run in range(repeat))
+        for fmt in RENDERERS
+    }
+
+
+UNITS = {"event_log_to_disk": HIGHER}
+"Anything not here is in LOWER"
+for fmt in RENDERERS:
+    UNITS[retrieve_name(fmt)] = HIGHER
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(
+            ("git", "rev-parse", "--short", "HEAD"),
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Pathy(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(count: int, repeat: int) -> dict:
+    fix = Fixtures(count)
+    results = {}
+    for bench in (bench_message, bench_helpers, bench_event_log, bench_retrieve):
+        print(f"Running {bench.__name__}", file=sys.stderr)
+        results.update(bench(fix, repeat))
+    return {
+        "version": kiroku.__version__,
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "count": count,
+        "repeat": repeat,
+        "results": {
+            name: {"value": round(value, 3), "unit": UNITS.get(name, LOWER)}
+            for name, value in results.items()
+        },
+    }
+
+
+def compare(new: dict, old: dict, threshold: float) -> list[str]:
+    """Benchmarks more than threshold percent worse than in old"""
+    print(f"\n{'':24} {old['version']:>12} {new['version']:>12}   change")
+    worse = []
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        if before is None:
+            print(f"{name:24} {'':>12} {result['value']:12.3f}   new")
+            continue
+        change = (result["value"] - before["value"]) / before["value"] * 100
+        if result["unit"] == HIGHER:
+            change = -change
+        # positive is slower
+        mark = ""
+        if change > threshold:
+            mark = " SLOWER"
+            worse.append(name)
+        elif change < -threshold:
+            mark = " faster"
+        print(
+            f"{name:24} {before['value']:12.3f} {result['value']:12.3f} {change:+7.1f}%{mark}"
+        )
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=10_000, help="Messages")
+    parser.add_argument("--repeat", type=int, default=5, help="Best of")
+    parser.add_argument(
+        "--out", type=Pathy, help="Results file, default results/<version>_<commit>"
+    )
+    parser.add_argument("--compare", type=Pathy, help="Earlier results file")
+    parser.add_argument(
+        "--threshold", type=float, default=10.0, help="Percent worse to call slower"
+    )
+    options = parser.parse_args()
+
+    results = run(options.count, options.repeat)
+    print(f"\n{results['count']} messages, best of {results['repeat']}")
+    for name, result in results["results"].items():
+        print(f"{name:24} {result['value']:12.3f} {result['unit']}")
+
+    out = options.out or RESULTS.joinpath(
+        f"{results['version']}_{results['commit'] or int(time.time())}.json"
+    )
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+    print(f"\nSaved {out}")
+
+    if options.compare:
+        old = json.loads(options.compare.read_text(encoding="utf-8"))
+        if compare(results, old, options.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+
+# MIT APasz
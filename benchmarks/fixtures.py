@@ -0,0 +1,279 @@
+"""Synthetic hikari objects shaped like what the gateway and REST hand the bot,
+and a fake app whose channel history comes in pages like fetch_history"""
+import asyncio
+import random
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path as Pathy
+from types import SimpleNamespace
+
+import hikari
+from hikari import Snowflake
+
+GUILD_ID = 1_000_000_000_000_000_001
+CHANNEL_ID = 1_000_000_000_000_000_002
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+WORDS = (
+    "the quick brown fox jumps over the lazy dog archive message channel "
+    "kiroku log retrieve export attachment embed link discord bot"
+).split()
+
+
+def make_user(number: int, bot: bool = False) -> hikari.User:
+    return hikari.users.UserImpl(
+        id=Snowflake(2_000_000_000_000_000_000 + number),
+        app=None,
+        discriminator="0",
+        username=f"user{number}",
+        global_name=f"User {number}",
+        avatar_hash=None,
+        banner_hash=None,
+        accent_color=None,
+        is_bot=bot,
+        is_system=False,
+        flags=hikari.UserFlag.NONE,
+    )
+
+
+def make_member(user: hikari.User, nickname: str | None = None) -> hikari.Member:
+    return hikari.guilds.Member(
+        guild_id=Snowflake(GUILD_ID),
+        is_deaf=False,
+        is_mute=False,
+        is_pending=False,
+        joined_at=START,
+        nickname=nickname,
+        premium_since=None,
+        raw_communication_disabled_until=None,
+        role_ids=[],
+        user=user,
+        guild_avatar_hash=None,
+        guild_flags=0,
+    )
+
+
+def make_attachment(number: int, expiry: int) -> hikari.Attachment:
+    return hikari.messages.Attachment(
+        id=Snowflake(3_000_000_000_000_000_000 + number),
+        url=(
+            f"https://cdn.discordapp.com/attachments/{CHANNEL_ID}/{number}/image_{number}.png"
+            f"?ex={expiry:x}&is={expiry - 86400:x}&hm={number:064x}&"
+        ),
+        filename=f"image_{number}.png",
+        title=None,
+        description=None,
+        media_type="image/png",
+        size=random.randint(10_000, 8_000_000),
+        proxy_url="",
+        height=1080,
+        width=1920,
+        is_ephemeral=False,
+        duration=None,
+        waveform=None,
+    )
+
+
+def make_embed(number: int) -> hikari.Embed:
+    embed = hikari.Embed(
+        title=f"Link preview {number}", url=f"https://example.com/{number}"
+    )
+    embed.set_author(name="Example", url="https://example.com")
+    return embed
+
+
+def make_message(
+    number: int,
+    author: hikari.User,
+    attachments: int = 0,
+    embeds: int = 0,
+    edited: bool = False,
+) -> hikari.Message:
+    created = START + timedelta(seconds=number * 7)
+    words = random.choices(WORDS, k=random.randint(1, 40))
+    return hikari.messages.Message(
+        app=None,
+        id=Snowflake(int(Snowflake.from_datetime(created)) + number % 4096),
+        channel_id=Snowflake(CHANNEL_ID),
+        guild_id=Snowflake(GUILD_ID),
+        user_mentions={},
+        role_mention_ids=[],
+        channel_mentions={},
+        mentions_everyone=False,
+        author=author,
+        member=None,
+        content=" ".join(words),
+        timestamp=created,
+        edited_timestamp=created + timedelta(minutes=2) if edited else None,
+        is_tts=False,
+        attachments=[
+            make_attachment(number * 10 + i, int(created.timestamp()) + 86400)
+            for i in range(attachments)
+        ],
+        embeds=[make_embed(number * 10 + i) for i in range(embeds)],
+        reactions=[],
+        is_pinned=False,
+        webhook_id=None,
+        type=hikari.MessageType.DEFAULT,
+        activity=None,
+        application=None,
+        message_reference=None,
+        flags=hikari.MessageFlag.NONE,
+        stickers=[],
+        nonce=None,
+        referenced_message=None,
+        interaction=None,
+        application_id=None,
+        components=[],
+        thread=None,
+    )
+
+
+class Fake_Guild:
+    """What the bot reads of a cached guild"""
+
+    def __init__(self, members: dict[int, hikari.Member]) -> None:
+        self.id = Snowflake(GUILD_ID)
+        self.name = "Bench Guild"
+        self.premium_tier = hikari.GuildPremiumTier.NONE
+        self.members = members
+
+    def __int__(self) -> int:
+        return GUILD_ID
+
+    def get_member(self, user_id: int) -> hikari.Member | None:
+        return self.members.get(int(user_id))
+
+
+class Fake_History:
+    """Newest first below before, in pages, like hikari's LazyIterator.chunk"""
+
+    def __init__(self, channel: "Fake_Channel", before) -> None:
+        self.channel = channel
+        self.before = before
+
+    async def chunk(self, size: int):
+        messages = self.channel.newest_first
+        if self.before is not hikari.UNDEFINED:
+            messages = [m for m in messages if m.id < int(self.before)]
+        for start in range(0, len(messages), size):
+            # a page is a request, even when it's instant
+            await asyncio.sleep(self.channel.page_secs)
+            yield tuple(messages[start : start + size])
+
+
+class Fake_Channel:
+    def __init__(self, messages: list[hikari.Message], page_secs: float = 0) -> None:
+        self.id = Snowflake(CHANNEL_ID)
+        self.name = "bench-channel"
+        self.guild_id = Snowflake(GUILD_ID)
+        self.newest_first = sorted(messages, key=lambda m: m.id, reverse=True)
+        self.page_secs = page_secs
+
+    def fetch_history(self, before=hikari.UNDEFINED, **kwargs) -> Fake_History:
+        return Fake_History(self, before)
+
+
+class Fake_App:
+    """Enough of GatewayBot for a retrieve job, everything is cached and posting goes nowhere"""
+
+    def __init__(self, guild: Fake_Guild, channel: Fake_Channel) -> None:
+        self.cache = SimpleNamespace(
+            get_guild=lambda guild_id: guild,
+            get_guild_channel=lambda channel_id: channel,
+        )
+        self.rest = SimpleNamespace(
+            create_message=self._create_message, fetch_member=self._fetch_member
+        )
+        self.guild = guild
+
+    async def _create_message(self, channel, content, **kwargs):
+        return None
+
+    async def _fetch_member(self, guild, user):
+        member = self.guild.get_member(user)
+        if member is None:
+            raise hikari.NotFoundError("", {}, b"")
+        return member
+
+
+class Fixtures:
+    """A guild's worth of authors and messages.
+    Roughly what a busy channel looks like, most messages are short text,
+    some carry attachments or link previews, a few were edited or sent by bots"""
+
+    def __init__(self, count: int, authors: int = 50, seed: int = 0) -> None:
+        random.seed(seed)
+        users = [make_user(i, bot=i % 25 == 0) for i in range(authors)]
+        # some authors have left, so have no member
+        self.members = {
+            int(user.id): make_member(user, nickname=f"nick{i}" if i % 2 else None)
+            for i, user in enumerate(users)
+            if i % 10
+        }
+        self.guild = Fake_Guild(self.members)
+        self.messages = [
+            make_message(
+                number=i,
+                author=users[i % authors],
+                attachments=1 if i % 8 == 0 else 0,
+                embeds=1 if i % 12 == 0 else 0,
+                edited=i % 15 == 0,
+            )
+            for i in range(count)
+        ]
+        self.channel = Fake_Channel(self.messages)
+
+    def event(self, message: hikari.Message) -> SimpleNamespace:
+        """What event_log reads of a GuildMessageCreateEvent"""
+        return SimpleNamespace(
+            message=message,
+            get_channel=lambda: self.channel,
+            get_guild=lambda: self.guild,
+            get_member=lambda: self.members.get(int(message.author.id)),
+        )
+
+    def args(self) -> list[tuple]:
+        """nice_message arguments for each message"""
+        return [
+            (
+                message,
+                self.members.get(int(message.author.id)),
+                self.guild,
+                self.channel,
+            )
+            for message in self.messages
+        ]
+
+    def app(self, page_secs: float = 0) -> Fake_App:
+        self.channel.page_secs = page_secs
+        return Fake_App(self.guild, self.channel)
+
+
+def sandbox() -> Pathy:
+    """Point everything the bot writes at a temporary folder, so a run leaves the checkout alone.
+    Defaults bound when kiroku was imported are pointed there too"""
+    from kiroku.util import file, manifest, mirror, timefmt
+
+    folder = Pathy(tempfile.mkdtemp(prefix="kiroku_bench_"))
+    paths = file.Paths
+    paths.logs = folder.joinpath("logs")
+    paths.data = folder.joinpath("data")
+    paths.jobs = folder.joinpath("data", "jobs")
+    paths.blobs = folder.joinpath("data", "blobs")
+    paths.zips = folder.joinpath("data", "zips")
+    paths.manifests = folder.joinpath("data", "manifests")
+    paths.file_db = folder.joinpath("data", "messages.sqlite3")
+    paths.file_zones = folder.joinpath("data", "timezones.json")
+    for made in (paths.logs, paths.data):
+        made.mkdir(parents=True, exist_ok=True)
+    manifest.Channel_Manifest.__init__.__defaults__ = (paths.manifests,)
+    mirror.Attachment_Mirror.__init__.__defaults__ = tuple(
+        paths.blobs if isinstance(default, Pathy) else default
+        for default in mirror.Attachment_Mirror.__init__.__defaults__
+    )
+    timefmt.Zones.file = paths.file_zones
+    return folder
+
+
+# MIT APasz
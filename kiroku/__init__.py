@@ -17,6 +17,82 @@ DATE_FORMAT = str(os.getenv("DATE_FORMAT"))
 MESS_SIZE = int(os.getenv("MAX_LOG_SIZE_MB")) * 1_000_000 - 5000
 "In bytes, maximum size of message files"
 
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", 10_000))
+"Maximum records waiting for the archive writer before backpressure applies"
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 500))
+"Maximum records the archive writer drains per batch"
+WRITE_FLUSH_SECS = float(os.getenv("WRITE_FLUSH_SECS", 1.0))
+"In seconds, longest a record may wait before being flushed to disk"
+WRITE_FSYNC = str(os.getenv("WRITE_FSYNC", "NEVER")).upper()
+"NEVER | FLUSH; whether to fsync each file after a flush"
+WRITE_BACKPRESSURE = str(os.getenv("WRITE_BACKPRESSURE", "WAIT")).upper()
+"WAIT | DROP; what listeners do when the writer queue is full"
+
+MAX_OPEN_LOGS = int(os.getenv("MAX_OPEN_LOGS", 256))
+"Maximum channel log files held open at once"
+LOG_IDLE_SECS = float(os.getenv("LOG_IDLE_SECS", 300))
+"In seconds, how long a channel log may sit unused before it is closed"
+ARCHIVE_FORMAT = str(os.getenv("ARCHIVE_FORMAT", "TXT")).upper()
+"TXT | NDJSON | BIN; encoding of the live channel logs"
+
+COMPRESS_ALGO = str(os.getenv("COMPRESS_ALGO", "GZIP")).upper()
+"NONE | GZIP | ZSTD; compression of closed log segments"
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", 6))
+"Compression level, GZIP 1-9 ZSTD 1-22"
+GUILD_QUOTA_MB = float(os.getenv("GUILD_QUOTA_MB", 0))
+"Disk quota per guild log folder, oldest segments are removed first. 0 for no limit"
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", 0))
+"Closed segments older than this are removed. 0 to keep forever"
+
+EDIT_DEBOUNCE_SECS = float(os.getenv("EDIT_DEBOUNCE_SECS", 3.0))
+"In seconds, updates to a message within this window are merged into one"
+EDIT_CACHE_SIZE = int(os.getenv("EDIT_CACHE_SIZE", 50_000))
+"Number of recent messages remembered for spotting updates that change nothing"
+
+TIMEZONE = str(os.getenv("TIMEZONE", "Australia/Melbourne"))
+"Timezone times are shown in for guilds that haven't set their own"
+
+MEMBER_FETCH_CONCURRENCY = int(os.getenv("MEMBER_FETCH_CONCURRENCY", 8))
+"Member fetches a retrieve may have in flight at once"
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", 2))
+"Retrieve jobs run at once, the rest wait their turn"
+JOB_CHECKPOINT_SECS = float(os.getenv("JOB_CHECKPOINT_SECS", 5.0))
+"In seconds, how often a running retrieve job saves its progress"
+ARCHIVE_CONCURRENCY = int(os.getenv("ARCHIVE_CONCURRENCY", 4))
+"Channels a guild archive walks at once"
+REST_BUDGET_PER_SEC = float(os.getenv("REST_BUDGET_PER_SEC", 10.0))
+"REST requests per second a guild archive may make across all its channels. 0 for no limit"
+EXPORT_COMPRESS = str(os.getenv("EXPORT_COMPRESS", "ZIP")).upper()
+"NONE | ZIP | GZIP | ZSTD; compression of exports before they're uploaded"
+UPLOAD_LIMIT_MB = float(os.getenv("UPLOAD_LIMIT_MB", 10))
+"Upload limit of guilds without boosts, exports bigger than the guild's limit are split into parts"
+MANIFEST_SYNC_KB = int(os.getenv("MANIFEST_SYNC_KB", 256))
+"In KiB, how far apart sync points of the channel log manifests are. /get with a window reads from the nearest"
+
+MIRROR_ATTACHMENTS = str(os.getenv("MIRROR_ATTACHMENTS", "NONE")).upper()
+"NONE | RETRIEVE | ALL; download attachments of retrieved, or all, messages before their links expire"
+MIRROR_CONCURRENCY = int(os.getenv("MIRROR_CONCURRENCY", 4))
+"Attachment downloads in flight at once"
+MIRROR_BANDWIDTH_KBPS = float(os.getenv("MIRROR_BANDWIDTH_KBPS", 0))
+"In KiB per second, cap on attachment downloads. 0 for no limit"
+MIRROR_MAX_MB = float(os.getenv("MIRROR_MAX_MB", 25))
+"Attachments bigger than this aren't mirrored"
+
+IO_WORKERS = int(os.getenv("IO_WORKERS", 4))
+"Threads file writes run on, off the event loop"
+METRICS_SECS = float(os.getenv("METRICS_SECS", 15))
+"In seconds, how often data/metrics.prom is written. 0 to not write it"
+METRICS_HOST = str(os.getenv("METRICS_HOST", "127.0.0.1"))
+"Address metrics are served on when METRICS_PORT is set, 0.0.0.0 for every interface"
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+"Port metrics are served on at /metrics, 0 to not serve them"
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", 40))
+"Lines of each profiling report section"
+JSON_CACHE_ENTRIES = int(os.getenv("JSON_CACHE_ENTRIES", 256))
+"JSON files Read_Write keeps parsed in memory, least recently read are dropped first"
+JSON_CACHE_MB = float(os.getenv("JSON_CACHE_MB", 8))
+"Size of the JSON files Read_Write keeps parsed in memory, by their size on disk"
+
 
 changelog_file = "changelog.json"
 cwd = Pathy(__file__).parent
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import typing
@@ -14,7 +15,15 @@ from hikari.impl.config import CacheSettings
 from lightbulb import BotApp
 import miru
 
-from kiroku.util.file import Paths
+from kiroku.util.database import Message_DB
+from kiroku.util.edits import Update_Coalescer
+from kiroku.util.file import Paths, Read_Write
+from kiroku.util.jobs import Job_Manager
+from kiroku.util.logs import Log_Registry
+from kiroku.util.metrics import Metrics_Exporter, metrics
+from kiroku.util.mirror import Attachment_Mirror
+from kiroku.util.segments import Segment_Worker
+from kiroku.util.writer import Archive_Writer
 
 from kiroku import SYSLOG, __version__, __version_tuple__
 from kiroku.store import Store
@@ -26,7 +35,49 @@ BOT_PREFIX = ">"
 Store.configs = {}
 Store.indev = bool(os.getenv("DEV"))
 Store.extensions_dict = {}
-Store.logs = {}
+Store.database = Message_DB()
+Store.segments = Segment_Worker()
+Store.logs = Log_Registry(on_roll=Store.segments.submit)
+Store.writer = Archive_Writer(logs=Store.logs, database=Store.database)
+Store.edits = Update_Coalescer(emit=Store.writer.put)
+Store.jobs = Job_Manager()
+Store.mirror = Attachment_Mirror()
+Store.metrics = Metrics_Exporter()
+
+metrics.gauge(
+    "logged_messages_total",
+    "Records written by the archive writer",
+    lambda: Store.writer.written,
+    kind="counter",
+)
+metrics.gauge(
+    "dropped_messages_total",
+    "Records dropped with the writer queue full",
+    lambda: Store.writer.dropped,
+    kind="counter",
+)
+metrics.gauge("open_logs", "Channel log files open", lambda: len(Store.logs))
+metrics.gauge(
+    "writer_queue", "Records waiting for the archive writer", Store.writer.queue.qsize
+)
+metrics.gauge(
+    "segment_queue",
+    "Closed segments waiting to be compressed",
+    Store.segments.queue.qsize,
+)
+metrics.gauge(
+    "pending_updates",
+    "Message updates being debounced",
+    lambda: Store.edits.pending,
+)
+metrics.gauge(
+    "running_jobs", "Retrieve jobs running or waiting", lambda: Store.jobs.running
+)
+metrics.gauge(
+    "pending_mirrors",
+    "Attachment downloads in flight",
+    lambda: Store.mirror.pending,
+)
 
 
 syslog = logging.getLogger(SYSLOG)
@@ -99,16 +150,29 @@ class KBot(BotApp):
     async def before_ready(self: KBotT, event: StartingEvent):  # noqa: D401
         """Fired before bot is ready"""
         syslog.debug("before_ready")
+        await asyncio.to_thread(Read_Write.load_cache)
+        Store.segments.start()
+        Store.writer.start()
         miru.install(self)
         autoload_extensions(self)
 
     async def on_ready(self: KBotT, event: StartedEvent):  # noqa: D401
         """Fired when bot is ready"""
         syslog.debug("on_ready")
+        Store.jobs.start(self)
+        await Store.metrics.start()
 
     async def on_close(self: KBotT, event: StoppingEvent):  # noqa: D401
         """Fired when bot is stopping"""
         syslog.critical("on_close")
+        await Store.jobs.stop()
+        await Store.mirror.close()
+        await Store.edits.flush_all()
+        await asyncio.to_thread(Store.writer.stop)
+        await asyncio.to_thread(Store.segments.stop)
+        Store.database.close()
+        await asyncio.to_thread(Read_Write.write_cache)
+        await Store.metrics.stop()
 
 
 # MIT APasz
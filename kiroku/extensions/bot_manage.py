@@ -1,10 +1,16 @@
+import asyncio
 import logging
+import time
 from lightbulb import errors
 
 import lightbulb
 
 from .. import SYSLOG
 from ..store import Store
+from ..util.file import Paths
+from ..util.metrics import metrics
+from ..util.profiler import TARGETS, memory, profiler
+from ..util.upload import send_file
 
 print(__name__)
 
@@ -45,6 +51,107 @@ async def ensure(ctx: lightbulb.Context):
     await ctx.respond("Synced!")
 
 
+@plugin.command
+@lightbulb.option(
+    name="prometheus",
+    description="As the Prometheus text format instead",
+    type=bool,
+    required=False,
+    default=False,
+)
+@lightbulb.command("metrics", "Throughput, latency and queue depths", ephemeral=True)
+@lightbulb.implements(lightbulb.SlashCommand, lightbulb.PrefixCommand)
+async def metrics_cmd(ctx: lightbulb.Context):
+    if ctx.options["prometheus"]:
+        text = metrics.render()
+    else:
+        text = metrics.summary()
+    # kept under the message length limit
+    await ctx.respond(f"```\n{text[:1900]}\n```")
+
+
+@plugin.command
+@lightbulb.command("profile", "Profiling Group", ephemeral=True)
+@lightbulb.implements(lightbulb.SlashCommandGroup, lightbulb.PrefixCommandGroup)
+async def profile(ctx: lightbulb.Context):
+    running = f"Profiling {', '.join(profiler.profiles)}" if profiler.active else ""
+    if memory.active:
+        running = f"{running}\nTracing allocations".strip()
+    await ctx.respond(running or "Not profiling")
+
+
+@profile.child
+@lightbulb.option(
+    name="targets",
+    description="ALL (default) | " + " | ".join(TARGETS) + ", comma separated",
+    type=str,
+    required=False,
+    default="ALL",
+)
+@lightbulb.command("start", "Profile listeners and commands", ephemeral=True)
+@lightbulb.implements(lightbulb.SlashSubCommand, lightbulb.PrefixSubCommand)
+async def profile_start(ctx: lightbulb.Context):
+    if profiler.active:
+        await ctx.respond("Already profiling, stop it first")
+        return
+    targets = ctx.options["targets"].replace(" ", "").split(",")
+    if "ALL" in (target.upper() for target in targets):
+        targets = list(TARGETS)
+    unknown = set(targets) - set(TARGETS)
+    if unknown:
+        await ctx.respond(f"Unknown targets; {', '.join(sorted(unknown))}")
+        return
+    profiler.start(targets)
+    await ctx.respond(f"Profiling {', '.join(targets)}")
+
+
+@profile.child
+@lightbulb.command("stop", "Stop profiling and upload the report", ephemeral=True)
+@lightbulb.implements(lightbulb.SlashSubCommand, lightbulb.PrefixSubCommand)
+async def profile_stop(ctx: lightbulb.Context):
+    if not profiler.active:
+        await ctx.respond("Not profiling")
+        return
+    file = Paths.data.joinpath(f"profile_{int(time.time())}.zip")
+    try:
+        await asyncio.to_thread(profiler.stop, file)
+        await send_file(
+            ctx.respond, file=file, content="Profile", guild=ctx.get_guild()
+        )
+    finally:
+        file.unlink(missing_ok=True)
+
+
+@profile.child
+@lightbulb.option(
+    name="action",
+    description="START tracing allocations | STOP and upload the difference",
+    choices=["START", "STOP"],
+)
+@lightbulb.command("memory", "Where memory is allocated", ephemeral=True)
+@lightbulb.implements(lightbulb.SlashSubCommand, lightbulb.PrefixSubCommand)
+async def profile_memory(ctx: lightbulb.Context):
+    if ctx.options["action"] == "START":
+        if memory.active:
+            await ctx.respond("Already tracing, stop it first")
+            return
+        await asyncio.to_thread(memory.start)
+        await ctx.respond("Tracing allocations")
+        return
+
+    if not memory.active:
+        await ctx.respond("Not tracing")
+        return
+    file = Paths.data.joinpath(f"memory_{int(time.time())}.txt")
+    try:
+        await asyncio.to_thread(memory.stop, file)
+        await send_file(
+            ctx.respond, file=file, content="Allocations", guild=ctx.get_guild()
+        )
+    finally:
+        file.unlink(missing_ok=True)
+
+
 @plugin.command
 @lightbulb.command("ext", "Extensions Group", ephemeral=True)
 @lightbulb.implements(lightbulb.SlashCommandGroup, lightbulb.PrefixCommandGroup)
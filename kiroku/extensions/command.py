@@ -1,19 +1,27 @@
+import asyncio
+import functools
 import logging
 import string
-import time
 import hikari
 
 import lightbulb
 from datetime import datetime
 from pathlib import Path as Pathy
 from dateutil import parser
-import os
-import shutil
+import pytz
+import re
 
-from kiroku.util.message import nice_message
+from kiroku.util.bundle import Guild_Archive
+from kiroku.util.logzip import Log_Zip
+from kiroku.util.profiler import profiled, profiler
+from kiroku.util.jobs import Retrieve_Job, new_job_id
+from kiroku.util.render import RENDERERS, Renderer, get_renderer, ts_snowflake
+from kiroku.util.timefmt import Zones
+from kiroku.util.upload import send_file
 
 from .. import SYSLOG, DATE_FORMAT
-from ..util.file import Read_Write, Paths
+from ..store import Store
+from ..util.file import Paths
 
 print(__name__)
 syslog = logging.getLogger(SYSLOG)
@@ -61,8 +69,27 @@ def parse_time(time: str) -> datetime | bool:
 
 
 @plugin.command
+@lightbulb.option(
+    name="to_date",
+    description="Only what was logged before this date. Timestamp | DMY | YMD",
+    required=False,
+    default=None,
+)
+@lightbulb.option(
+    name="from_date",
+    description="Only what was logged from this date. Timestamp | DMY | YMD",
+    required=False,
+    default=None,
+)
+@lightbulb.option(
+    name="format",
+    description="RAW (default) | " + " | ".join(RENDERERS),
+    choices=["RAW", *RENDERERS],
+    default="RAW",
+)
 @lightbulb.command("get", "Get real time message log files for current Guild")
 @lightbulb.implements(lightbulb.SlashCommand, lightbulb.PrefixCommand)
+@profiled("get")
 async def get(ctx: lightbulb.Context):
     syslog.warning(
         f"Message logs for {ctx.guild_id} requested by {ctx.author.username} ({ctx.author.id})"
@@ -70,14 +97,73 @@ async def get(ctx: lightbulb.Context):
 
     guild = ctx.get_guild()
     name = f"{guild.name}_({guild.id})"
-    guild_folder: Pathy = Paths.logs.joinpath(name)
+    # logs are found by ID, the folder keeps the name the guild had when first logged
+    guild_folder: Pathy = next(
+        Paths.logs.glob(f"*_({guild.id})"), Paths.logs.joinpath(name)
+    )
     zipfile: Pathy = Paths.data.joinpath(f"{name}_{get_time()}.zip")
 
-    if zipfile.exists():
-        os.remove(zipfile)
-    zipfile = shutil.make_archive(zipfile.stem, "zip", guild_folder)
+    window = {}
+    for option, key in (("from_date", "from_ts"), ("to_date", "to_ts")):
+        if not ctx.options[option]:
+            continue
+        date = parse_time(ctx.options[option])
+        if not date:
+            syslog.info(f"Unrecognisable {option} passed")
+            await ctx.respond(f"{option.capitalize()} not recognised")
+            return
+        window[key] = date.timestamp()
+    if window.get("from_ts", 0) >= window.get("to_ts", float("inf")):
+        await ctx.respond("To_date must be after from_date")
+        return
+
+    log_zip = Log_Zip(
+        guild_folder=guild_folder,
+        guild_id=int(guild.id),
+        fmt=ctx.options["format"],
+        **window,
+    )
+    try:
+        await asyncio.to_thread(profiler.call, "get", log_zip.build, zipfile)
+        if log_zip.windowed and not log_zip.added:
+            await ctx.respond("Nothing was logged between those dates")
+            return
+        await send_file(ctx.respond, file=zipfile, content="Message Logs", guild=guild)
+    finally:
+        zipfile.unlink(missing_ok=True)
+
 
-    await ctx.respond("Message Logs", attachment=zipfile)
+async def incremental_start(
+    chan: hikari.TextableGuildChannel, renderer: Renderer, from_date: datetime | None
+) -> dict | None:
+    """Job fields carrying on from the channel's watermark, None if a job already has its archive open"""
+    file_path = Paths.data.joinpath(
+        f"{chan.name}_({chan.id})_incremental{renderer.ext}"
+    )
+    mark = await asyncio.to_thread(
+        Store.database.watermark, int(chan.id), renderer.name
+    )
+    if mark and Pathy(mark.file).exists():
+        file_path = Pathy(mark.file)
+    else:
+        mark = None
+    for other in Store.jobs.for_guild(chan.guild_id):
+        if not other.finished and other.file == str(file_path):
+            return None
+
+    fields = {"file": file_path, "incremental": True}
+    if mark:
+        fields.update(
+            after=mark.message_id,
+            mark=mark.message_id,
+            edited_since=mark.edited_at or 0,
+            written=mark.total,
+            base=mark.total,
+            offset=mark.offset,
+        )
+    elif from_date:
+        fields["after"] = ts_snowflake(from_date.timestamp())
+    return fields
 
 
 @plugin.command
@@ -88,16 +174,29 @@ async def get(ctx: lightbulb.Context):
     required=False,
     default=-1,
 )
+@lightbulb.option(
+    name="to_date",
+    description="Date to retrieve messages up to, not including. Timestamp | DMY | YMD",
+    required=False,
+    default=None,
+)
 @lightbulb.option(
     name="from_date",
     description="Date to retrieve messages back to. Timestamp | DMY | YMD",
     required=False,
     default=None,
 )
+@lightbulb.option(
+    name="incremental",
+    description="Add only what's new since the last incremental retrieve to its archive",
+    type=bool,
+    required=False,
+    default=False,
+)
 @lightbulb.option(
     name="format",
-    description="JSON | TXT (default) | TXT [COMPACT]",
-    choices=["JSON", "TXT", "TXT [COMPACT]"],
+    description=" | ".join(RENDERERS) + ", TXT (default)",
+    choices=list(RENDERERS),
     default="TXT",
 )
 @lightbulb.command(
@@ -132,106 +231,203 @@ async def retrieve(ctx: lightbulb.Context):
             await ctx.respond("From_date not recognised")
             return
 
+    to_ts = to_date = ctx.options["to_date"]
+    if to_date:
+        to_date = parse_time(to_date)
+        if to_date:
+            to_ts = int(to_date.timestamp())
+        else:
+            syslog.info("Unrecognisable to_date passed")
+            await ctx.respond("To_date not recognised")
+            return
+        if from_date and from_ts >= to_ts:
+            await ctx.respond("To_date must be after from_date")
+            return
+
     limit_tot = limit = ctx.options["limit"]
     if limit == -1:
         limit_tot = None
 
-    syslog.warning(f"Message retrieval {limit=} {from_date=}")
+    syslog.warning(f"Message retrieval {limit=} {from_date=} {to_date=}")
 
-    fmt = ctx.options["format"]
-    JSON = TXT = COMPACT = False
+    renderer = get_renderer(ctx.options["format"])
 
-    if "TXT" in fmt:
-        TXT = True
-        data = []
-        if "COMPACT" in fmt:
-            COMPACT = True
-    elif "JSON" in fmt:
-        JSON = True
-        data = {}
+    file_path = Paths.data.joinpath(
+        f"{guild.name}_{chan.name}_{get_time()}{renderer.ext}"
+    )
+    incremental = {}
+    if ctx.options["incremental"]:
+        incremental = await incremental_start(chan, renderer, from_date)
+        if incremental is None:
+            await ctx.respond("An incremental retrieve of this channel is underway")
+            return
+        file_path = incremental.pop("file")
+        # carries on to the newest message
+        limit_tot = to_date = None
+
+    job = Retrieve_Job(
+        job_id=new_job_id(),
+        guild_id=int(guild.id),
+        channel_id=int(chan.id),
+        requester_id=int(ctx.author.id),
+        fmt=renderer.name,
+        file=str(file_path),
+        limit=limit_tot,
+        from_ts=from_ts if from_date else None,
+        from_date=f"{from_date} : {from_ts}" if from_date else None,
+        to_ts=to_ts if to_date else None,
+        to_date=f"{to_date} : {to_ts}" if to_date else None,
+        # the walk seeks straight to to_date rather than reading down to it
+        before=ts_snowflake(to_ts) if to_date else None,
+        **incremental,
+    )
+    Store.jobs.submit(job)
+    await ctx.respond(
+        f"Retrieving as job `{job.job_id}`, the archive will be posted here when done. /job to check on it"
+    )
 
-    history = chan.fetch_history()
 
-    total_messages = 0
+@plugin.command
+@lightbulb.option(
+    name="job_id",
+    description="Job to check on, leave empty to list this Guild's jobs",
+    required=False,
+    default=None,
+)
+@lightbulb.command("job", "Progress of retrieve jobs")
+@lightbulb.implements(lightbulb.SlashCommand, lightbulb.PrefixCommand)
+async def job(ctx: lightbulb.Context):
+    job_id = ctx.options["job_id"]
+    if job_id:
+        found = Store.jobs.get(job_id.strip())
+        if found is None or found.guild_id != ctx.guild_id:
+            await ctx.respond(f"No job {job_id}")
+            return
+        await ctx.respond(found.describe())
+        return
+
+    jobs = Store.jobs.for_guild(ctx.guild_id)[:10]
+    if not jobs:
+        await ctx.respond("No jobs")
+        return
+    await ctx.respond("\n".join(found.describe() for found in jobs))
+
+
+archives: set[asyncio.Task] = set()
+"Guild archives underway, held so they aren't collected mid-run"
+
+
+def archive_channels(
+    guild: hikari.Guild, only: set[int] | None = None
+) -> list[hikari.TextableGuildChannel]:
+    """Textable channels the bot can read history in, only= limits it to those IDs"""
+    me = guild.get_my_member()
+    needed = hikari.Permissions.VIEW_CHANNEL | hikari.Permissions.READ_MESSAGE_HISTORY
+    channels = []
+    for chan in guild.get_channels().values():
+        if not isinstance(chan, hikari.TextableGuildChannel):
+            continue
+        if only and int(chan.id) not in only:
+            continue
+        perms = lightbulb.utils.permissions_in(chan, me)
+        if hikari.Permissions.ADMINISTRATOR in perms or needed in perms:
+            channels.append(chan)
+    return channels
 
-    async for message in history:
-        total_messages += 1
 
-        if limit_tot:
-            if limit > 0:
-                limit -= 1
-            else:
-                syslog.info("reached message limit")
-                break
+@plugin.command
+@lightbulb.option(
+    name="channels",
+    description="Channels to archive, as mentions or IDs. Leave empty for all",
+    required=False,
+    default=None,
+)
+@lightbulb.option(
+    name="format",
+    description=" | ".join(RENDERERS) + ", TXT (default)",
+    choices=list(RENDERERS),
+    default="TXT",
+)
+@lightbulb.command(
+    "archive", "Retrieve messages from every channel of this Guild into one zip"
+)
+@lightbulb.implements(lightbulb.SlashCommand, lightbulb.PrefixCommand)
+async def archive(ctx: lightbulb.Context):
+    perms = lightbulb.utils.permissions_for(ctx.member)
+    if hikari.Permissions.MANAGE_GUILD not in perms:
+        raise lightbulb.MissingRequiredPermission(perms=hikari.Permissions.MANAGE_GUILD)
+
+    guild: hikari.Guild = ctx.get_guild()
+    only = None
+    if ctx.options["channels"]:
+        only = {
+            int(chan_id)
+            for chan_id in re.findall(r"\d{15,21}", ctx.options["channels"])
+        }
+    channels = archive_channels(guild, only=only)
+    if not channels:
+        await ctx.respond("No channels to archive")
+        return
 
-        if from_date:
-            if from_ts > message.created_at.timestamp():
-                syslog.info("reached from_date limit")
-                break
-
-        mem = message.member
-        if not mem:
-            mem = guild.get_member(message.author.id)
-        if not mem:
-            try:
-                mem = await ctx.app.rest.fetch_member(
-                    guild=guild, user=message.author.id
-                )
-            except hikari.NotFoundError:
-                syslog.error("Unknown Memeber: %s", message.author.id)
-                mem = None
-            except Exception:
-                syslog.exception("Fetch Member")
-                mem = None
+    syslog.warning(
+        f"Archiving {len(channels)} channels of {guild.name} ({guild.id}) requested by {ctx.author.username} ({ctx.author.id})"
+    )
+    renderer = get_renderer(ctx.options["format"])
+    guild_archive = Guild_Archive(
+        app=ctx.app, guild=guild, channels=channels, renderer=renderer
+    )
+    file_path = Paths.data.joinpath(f"{guild.name}_({guild.id})_{get_time()}.zip")
+    requester = int(ctx.author.id)
+    channel_id = ctx.channel_id
+
+    async def run():
         try:
-            mess = nice_message(
-                mess_obj=message, memb_obj=mem, chan_obj=chan, guil_obj=guild
+            await guild_archive.run(file_path)
+            content = f"<@{requester}> Guild archive, {guild_archive.total} messages from {len(guild_archive.totals)} channels"
+            if guild_archive.failed:
+                content += f", {len(guild_archive.failed)} failed"
+            send = functools.partial(
+                ctx.app.rest.create_message, channel_id, user_mentions=[requester]
             )
+            await send_file(send, file=file_path, content=content, guild=guild)
         except Exception:
-            syslog.exception("Retrieval error")
-
-        if TXT:
-            if COMPACT:
-                data.append(mess.stringise_compact())
-            else:
-                data.append(mess.stringise())
-        elif JSON:
-            data[str(mess.message_id)] = mess.jsonise()
+            syslog.exception("Guild archive")
 
-        time.sleep(0.008)
-
-    if TXT and COMPACT:
-        fmt = "TXT"
-    file_path = Paths.data.joinpath(
-        f"{guild.name}_{chan.name}_{get_time()}.{fmt.lower()}"
+    task = asyncio.create_task(run(), name=f"archive_{guild.id}")
+    archives.add(task)
+    task.add_done_callback(archives.discard)
+    await ctx.respond(
+        f"Archiving {len(channels)} channels, the archive will be posted here when done"
     )
 
-    if TXT:
-        data.insert(
-            0,
-            f"Guild ID: {guild.id} | Channel ID: {chan.id} | Total Messages: {total_messages}",
-        )
 
-        sec_line = []
-        if limit_tot:
-            sec_line.append(f"Limit: {limit_tot}")
-        if from_date:
-            sec_line.append(f"From Date: {from_date} : {from_ts}")
-
-        sec_line = " | ".join(sec_line)
-        if len(sec_line) > 0:
-            sec_line = sec_line + "\n"
-            data.insert(1, sec_line)
-
-        Read_Write.write_txt(data="\n".join(data), file=file_path)
-    elif JSON:
-        kata = {}
-        kata["guild_id"] = guild.id
-        kata["channel_id"] = chan.id
-        kata["total_messages"] = total_messages
-        if limit_tot:
-            kata["limit"] = limit_tot
-        if from_date:
-            kata["from_date"] = f"{from_date} : {from_ts}"
-        Read_Write.write_json(data=kata | data, file=file_path)
-    await ctx.respond("Message archive", attachment=file_path)
+@plugin.command
+@lightbulb.option(
+    name="zone",
+    description="IANA timezone, e.g. Australia/Melbourne. DEFAULT to reset, leave empty to show",
+    required=False,
+    default=None,
+)
+@lightbulb.command("timezone", "Timezone times are shown in for this Guild")
+@lightbulb.implements(lightbulb.SlashCommand, lightbulb.PrefixCommand)
+async def timezone(ctx: lightbulb.Context):
+    zone = ctx.options["zone"]
+    if zone is None:
+        await ctx.respond(f"Timezone: {Zones.zone_name(ctx.guild_id)}")
+        return
+
+    perms = lightbulb.utils.permissions_for(ctx.member)
+    if hikari.Permissions.MANAGE_GUILD not in perms:
+        raise lightbulb.MissingRequiredPermission(perms=hikari.Permissions.MANAGE_GUILD)
+
+    if zone.strip().upper() == "DEFAULT":
+        zone = None
+    try:
+        zone = await asyncio.to_thread(Zones.set, ctx.guild_id, zone)
+    except pytz.UnknownTimeZoneError:
+        await ctx.respond(f"Unknown timezone: {zone}")
+        return
+    syslog.warning(
+        f"Timezone for {ctx.guild_id} set to {zone} by {ctx.author.username} ({ctx.author.id})"
+    )
+    await ctx.respond(f"Timezone set to {zone}")
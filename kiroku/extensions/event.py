@@ -1,11 +1,19 @@
 import logging
+import time
 
-from hikari.events import GuildMessageCreateEvent, GuildMessageUpdateEvent
+import hikari
+from hikari.events import (
+    GuildMessageCreateEvent,
+    GuildMessageUpdateEvent,
+    ShardReadyEvent,
+)
 
 import lightbulb
 
 from .. import SYSLOG
-from ..util.message import nice_message, get_logger
+from ..store import Store
+from ..util.message import nice_message, embed_record, get_logger
+from ..util.profiler import profiled
 
 
 print(__name__)
@@ -22,35 +30,95 @@ def unload(bot: lightbulb.BotApp):
     bot.remove_plugin(plugin)
 
 
-def log_message(mess: nice_message, chan_name: str, guild_name: str):
-    """Transform event to log"""
+async def log_message(
+    mess: nice_message,
+    chan_name: str,
+    guild_name: str,
+    live: bool = False,
+    received: float | None = None,
+):
+    """Transform event to log, rendering and writing happen on the archive writer.
+    live= a new message, so the database can count it towards coverage.
+    received= time.monotonic() when the event was handled"""
     log = get_logger(mess=mess, chan_name=chan_name, guild_name=guild_name)
-    log.info(mess.stringise())
+    record = mess.recordise()
+    session = None
+    if live:
+        session = Store.database.session
+        Store.edits.seen(record)
+        if Store.mirror.live:
+            Store.mirror.submit([record])
+    await Store.writer.put(log=log, record=record, session=session, received=received)
+
+
+def update_message(
+    mess: nice_message, chan_name: str, guild_name: str, old: hikari.Message | None
+):
+    """Hand an update to the coalescer, which decides if and how it gets logged"""
+    log = get_logger(mess=mess, chan_name=chan_name, guild_name=guild_name)
+    old_record = None
+    if old is not None:
+        old_record = {
+            "message_id": int(old.id),
+            "content": old.content,
+            "attachments": [{"id": int(attach.id)} for attach in old.attachments],
+            "embeds": [embed_record(embed) for embed in old.embeds],
+        }
+    Store.edits.update(log=log, record=mess.update_record(), old=old_record)
+
+
+@plugin.listener(ShardReadyEvent)
+async def ready(event: ShardReadyEvent):
+    # a new session may have missed messages, so live coverage starts over
+    syslog.debug("shard ready event")
+    Store.database.reset_live()
 
 
 # Message Events
 
 
-def event_log(event):
+async def event_log(event, live: bool = False):
     """shortcut func"""
+    received = time.monotonic()
     ch = event.get_channel()
     gu = event.get_guild()
     nm = nice_message(
         mess_obj=event.message, memb_obj=event.get_member(), chan_obj=ch, guil_obj=gu
     )
-    log_message(mess=nm, chan_name=ch.name, guild_name=gu.name)
+    await log_message(
+        mess=nm, chan_name=ch.name, guild_name=gu.name, live=live, received=received
+    )
 
 
 @plugin.listener(GuildMessageCreateEvent)
+@profiled("mesc")
 async def mesc(event: GuildMessageCreateEvent):
     syslog.debug("message create event")
-    event_log(event)
+    try:
+        await event_log(event, live=True)
+    except Exception:
+        # the message isn't stored, live coverage can't run across it
+        Store.database.reset_live()
+        raise
+
+
+async def event_update(event: GuildMessageUpdateEvent):
+    """shortcut func"""
+    ch = event.get_channel()
+    gu = event.get_guild()
+    nm = nice_message(
+        mess_obj=event.message, memb_obj=event.get_member(), chan_obj=ch, guil_obj=gu
+    )
+    update_message(
+        mess=nm, chan_name=ch.name, guild_name=gu.name, old=event.old_message
+    )
 
 
 @plugin.listener(GuildMessageUpdateEvent)
+@profiled("mesu")
 async def mesu(event: GuildMessageUpdateEvent):
     syslog.debug("message update event")
-    event_log(event)
+    await event_update(event)
 
 
 # MIT APasz
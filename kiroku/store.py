@@ -1,7 +1,16 @@
 """For storing data"""
 from dataclasses import dataclass
-
-from logging import Logger
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .util.database import Message_DB
+    from .util.edits import Update_Coalescer
+    from .util.jobs import Job_Manager
+    from .util.logs import Log_Registry
+    from .util.metrics import Metrics_Exporter
+    from .util.mirror import Attachment_Mirror
+    from .util.segments import Segment_Worker
+    from .util.writer import Archive_Writer
 
 print(__name__)
 
@@ -21,9 +30,16 @@ class Singleton(type):
 class Store(metaclass=Singleton):
     """For storing data"""
 
-    logs: dict[int, Logger]
+    logs: "Log_Registry"
     indev: bool
     extensions_dict: dict
+    writer: "Archive_Writer"
+    segments: "Segment_Worker"
+    database: "Message_DB"
+    edits: "Update_Coalescer"
+    jobs: "Job_Manager"
+    mirror: "Attachment_Mirror"
+    metrics: "Metrics_Exporter"
 
 
 # MIT APasz
@@ -0,0 +1,156 @@
+"""Live archive formats, and converting archived segments into the retrieve formats"""
+import itertools
+import logging
+import struct
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from pathlib import Path as Pathy
+
+from .. import SYSLOG, DATE_FORMAT, MIRROR_ATTACHMENTS
+from ..util import serial
+from ..util.export import Export_Writer
+from ..util.mirror import rewrite
+from ..util.render import get_renderer, record_ts, render_txt
+from ..util.segments import is_compressed, open_segment
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+LENGTH = struct.Struct(">I")
+"Length prefix of each BIN record"
+
+
+def encode_txt(created: float, record: dict) -> bytes:
+    """Human readable, as the logs have always been"""
+    asctime = time.strftime(DATE_FORMAT, time.localtime(created))
+    return f"{asctime}|{created:.0f} || {render_txt(record)}\n".encode("utf-8")
+
+
+def encode_ndjson(created: float, record: dict) -> bytes:
+    """One JSON record per line"""
+    return serial.dumps(record) + b"\n"
+
+
+def encode_bin(created: float, record: dict) -> bytes:
+    """Length prefixed JSON record"""
+    payload = serial.dumps(record)
+    return LENGTH.pack(len(payload)) + payload
+
+
+def iter_ndjson(file: Pathy) -> Iterator[dict]:
+    """Stream records from a NDJSON segment"""
+    with open_segment(file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield serial.loads_record(line)
+            except ValueError:
+                syslog.error("Bad record in %s", file)
+
+
+def iter_bin(file: Pathy) -> Iterator[dict]:
+    """Stream records from a BIN segment"""
+    with open_segment(file) as f:
+        while header := f.read(LENGTH.size):
+            if len(header) < LENGTH.size:
+                syslog.error("Truncated header in %s", file)
+                return
+            (size,) = LENGTH.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                syslog.error("Truncated record in %s", file)
+                return
+            try:
+                yield serial.loads_record(payload)
+            except ValueError:
+                syslog.error("Bad record in %s", file)
+
+
+@dataclass(frozen=True, slots=True)
+class Archive_Format:
+    """How a live archive segment is encoded"""
+
+    name: str
+    ext: str
+    encode: Callable[[float, dict], bytes]
+    decode: Callable[[Pathy], Iterator[dict]] | None
+
+
+FORMATS = {
+    "TXT": Archive_Format(name="TXT", ext=".log", encode=encode_txt, decode=None),
+    "NDJSON": Archive_Format(
+        name="NDJSON", ext=".ndjson", encode=encode_ndjson, decode=iter_ndjson
+    ),
+    "BIN": Archive_Format(name="BIN", ext=".bin", encode=encode_bin, decode=iter_bin),
+}
+
+
+def get_format(name: str) -> Archive_Format:
+    """Archive format by name, falling back to TXT"""
+    fmt = FORMATS.get(name.upper())
+    if fmt is None:
+        syslog.warning("Unknown archive format %s, using TXT", name)
+        fmt = FORMATS["TXT"]
+    return fmt
+
+
+def format_for(file: Pathy) -> Archive_Format | None:
+    """Archive format of a segment file, None if not machine readable"""
+    if is_compressed(file):
+        file = file.with_suffix("")
+    for fmt in FORMATS.values():
+        if fmt.decode and file.suffix == fmt.ext:
+            return fmt
+    return None
+
+
+def iter_records(file: Pathy) -> Iterator[dict]:
+    """Stream records from a machine readable segment"""
+    fmt = format_for(file)
+    if fmt is None:
+        raise ValueError(f"Not a machine readable archive: {file}")
+    return fmt.decode(file)
+
+
+def convert(
+    src: Pathy,
+    dst: Pathy,
+    fmt: str,
+    from_ts: float | None = None,
+    to_ts: float | None = None,
+) -> int:
+    """Render a segment into one of the output formats, streaming record by record.
+    fmt= any registered renderer. from_ts/to_ts= only records from and up to, not including, these times.
+    Returns number of messages"""
+    syslog.debug("Converting %s to %s", src, fmt)
+    renderer = get_renderer(fmt)
+    render = renderer.render
+
+    records = iter_records(src)
+    if from_ts is not None or to_ts is not None:
+        records = (
+            record
+            for record in records
+            if (from_ts is None or record_ts(record) >= from_ts)
+            and (to_ts is None or record_ts(record) < to_ts)
+        )
+    first = next(records, None)
+    if first is None:
+        return 0
+
+    head = {"guild_id": first["guild_id"], "channel_id": first["channel_id"]}
+    records = itertools.chain((first,), records)
+    with Export_Writer(file=dst, renderer=renderer, head=head) as writer:
+        while batch := list(itertools.islice(records, 500)):
+            if MIRROR_ATTACHMENTS != "NONE":
+                # mirrored attachments show their blob
+                rewrite(batch)
+            for record in batch:
+                writer.write(record, render(record, None))
+    return writer.total
+
+
+# MIT APasz
@@ -0,0 +1,54 @@
+"""Sharing a REST request budget between concurrent tasks"""
+import asyncio
+import logging
+import time
+
+from .. import SYSLOG
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+
+class Rate_Budget:
+    """Token bucket, every request takes a token (or cost of them) and tokens refill at rate per second.
+    Shared by everything in one run so together they stay under the rate, however many there are
+    """
+
+    def __init__(self, rate: float, burst: int | None = None) -> None:
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.taken = 0
+        self.waited = 0.0
+        "Seconds spent waiting on tokens"
+
+    def __str__(self) -> str:
+        return f"requests {self.taken}, waited {self.waited:.1f}s"
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    async def take(self, cost: float = 1):
+        """Wait for tokens, waiters are served in turn.
+        A cost over burst is let through once the bucket is full, and paid off by whoever's next
+        """
+        async with self._lock:
+            self.taken += 1
+            if self.rate <= 0:
+                return
+            self._refill()
+            need = min(cost, self.burst)
+            if self._tokens < need:
+                wait = (need - self._tokens) / self.rate
+                self.waited += wait
+                await asyncio.sleep(wait)
+                self._refill()
+            self._tokens -= cost
+
+
+# MIT APasz
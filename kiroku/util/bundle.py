@@ -0,0 +1,158 @@
+"""Archiving many channels of a guild at once into one bundle"""
+import asyncio
+import logging
+import shutil
+import time
+import zipfile
+from collections.abc import Iterable
+from contextlib import aclosing
+from pathlib import Path as Pathy
+
+import hikari
+
+from .. import SYSLOG, ARCHIVE_CONCURRENCY, REST_BUDGET_PER_SEC
+from ..store import Store
+from ..util import serial
+from ..util.budget import Rate_Budget
+from ..util.export import Export_Writer
+from ..util.file import run_io
+from ..util.history import history_records
+from ..util.members import Member_Resolver
+from ..util.metrics import RETRIEVED
+from ..util.render import Renderer, render_many
+from ..util.timefmt import Zones
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+
+def entry_name(chan: hikari.GuildChannel, ext: str) -> str:
+    """Name of a channel's file in the bundle, by ID so renames don't collide"""
+    name = str(chan.name).replace("/", "_").replace("\\", "_")
+    return f"{name}_({chan.id}){ext}"
+
+
+class Guild_Archive:
+    """Many channels of one guild, walked a few at a time and bundled into one zip.
+    The channels share a member resolver and a REST budget, so more channels don't mean more requests per second
+    """
+
+    def __init__(
+        self,
+        app: hikari.RESTAware,
+        guild: hikari.Guild,
+        channels: Iterable[hikari.TextableGuildChannel],
+        renderer: Renderer,
+        concurrency: int = ARCHIVE_CONCURRENCY,
+        rate: float = REST_BUDGET_PER_SEC,
+    ) -> None:
+        self.app = app
+        self.guild = guild
+        self.channels = list(channels)
+        self.renderer = renderer
+        self.tf = Zones.get(guild.id)
+        self.budget = Rate_Budget(rate=rate)
+        self.resolver = Member_Resolver(app=app, guild=guild, budget=self.budget)
+        self._limit = asyncio.Semaphore(concurrency)
+        self.totals: dict[int, int] = {}
+        "Messages written per channel"
+        self.failed: dict[int, str] = {}
+
+    def __str__(self) -> str:
+        return f"channels {len(self.totals)}/{len(self.channels)}, messages {self.total}, failed {len(self.failed)}, {self.resolver}, {self.budget}"
+
+    @property
+    def total(self) -> int:
+        return sum(self.totals.values())
+
+    async def run(self, file: Pathy) -> Pathy:
+        """Archive every channel, then bundle them into file"""
+        folder = file.with_name(f"{file.stem}_parts")
+        folder.mkdir(exist_ok=True, parents=True)
+        try:
+            await asyncio.gather(
+                *(self._channel(chan, folder) for chan in self.channels)
+            )
+            await asyncio.to_thread(self.bundle, folder, file)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, folder, ignore_errors=True)
+        syslog.info("Archived %s, %s", self.guild.id, self)
+        return file
+
+    async def _channel(self, chan: hikari.TextableGuildChannel, folder: Pathy):
+        async with self._limit:
+            file = folder.joinpath(entry_name(chan, self.renderer.ext))
+            head = {
+                "guild_id": int(self.guild.id),
+                "channel_id": int(chan.id),
+                "total_messages": 0,
+            }
+            render = self.renderer.render
+            batch = []
+
+            async def flush():
+                if Store.mirror.retrieve:
+                    await Store.mirror.mirror(batch)
+                records = list(batch)
+                batch.clear()
+                rendered = render_many(records, render, self.tf)
+                await run_io(writer.write_many, records, rendered)
+                RETRIEVED.inc(len(records))
+
+            try:
+                with Export_Writer(
+                    file=file, renderer=self.renderer, head=head
+                ) as writer:
+                    history = history_records(
+                        self.app,
+                        self.guild,
+                        chan,
+                        resolver=self.resolver,
+                        budget=self.budget,
+                    )
+                    async with aclosing(history) as history:
+                        async for record in history:
+                            batch.append(record)
+                            if len(batch) >= 100:
+                                await flush()
+                    if batch:
+                        await flush()
+            except Exception as e:
+                # one channel failing doesn't sink the rest
+                syslog.exception("Archive channel %s", chan.id)
+                self.failed[int(chan.id)] = str(e) or type(e).__name__
+                file.unlink(missing_ok=True)
+                return
+            self.totals[int(chan.id)] = writer.total
+            syslog.debug("Archived channel %s, %s messages", chan.id, writer.total)
+
+    def bundle(self, folder: Pathy, file: Pathy):
+        """Zip the channel files with a manifest of what's in it"""
+        channels = [
+            {
+                "channel_id": int(chan.id),
+                "name": chan.name,
+                "file": entry_name(chan, self.renderer.ext),
+                "total_messages": self.totals[int(chan.id)],
+            }
+            for chan in self.channels
+            if int(chan.id) in self.totals
+        ]
+        manifest = {
+            "guild_id": int(self.guild.id),
+            "guild_name": self.guild.name,
+            "format": self.renderer.name,
+            "created_at_ts": round(time.time(), 3),
+            "total_messages": self.total,
+            "channels": channels,
+            "failed": {str(chan_id): error for chan_id, error in self.failed.items()},
+        }
+        file.parent.mkdir(exist_ok=True, parents=True)
+        with zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("manifest.json", serial.dumps_pretty(manifest))
+            for entry in channels:
+                zf.write(folder.joinpath(entry["file"]), arcname=entry["file"])
+
+
+# MIT APasz
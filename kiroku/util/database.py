@@ -0,0 +1,303 @@
+"""Local SQLite store of messages, so retrieve can skip history it has already seen"""
+import logging
+import sqlite3
+import threading
+from collections.abc import Iterable
+from dataclasses import astuple, dataclass
+from pathlib import Path as Pathy
+
+from .. import SYSLOG
+from ..util import serial
+from ..util.file import Paths
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    message_id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    edited_at REAL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_id, message_id);
+CREATE INDEX IF NOT EXISTS messages_guild ON messages (guild_id, created_at);
+CREATE INDEX IF NOT EXISTS messages_author ON messages (author_id, created_at);
+CREATE TABLE IF NOT EXISTS coverage (
+    channel_id INTEGER NOT NULL,
+    start_id INTEGER NOT NULL,
+    end_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS coverage_channel ON coverage (channel_id, end_id);
+CREATE TABLE IF NOT EXISTS watermarks (
+    channel_id INTEGER NOT NULL,
+    fmt TEXT NOT NULL,
+    file TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    edited_at REAL,
+    total INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    PRIMARY KEY (channel_id, fmt)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    attachment_id INTEGER PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    blob TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_sha256 ON blobs (sha256);
+"""
+
+
+@dataclass(slots=True)
+class Watermark:
+    """How far an incremental export of a channel has got"""
+
+    channel_id: int
+    fmt: str
+    file: str
+    message_id: int
+    "Newest message in the export"
+    edited_at: float | None
+    "Latest edit in the export"
+    total: int
+    offset: int
+    "Where the export's body ends, appending carries on from here"
+
+
+class Message_DB:
+    """Messages keyed by snowflake, plus spans of each channel known to be complete.
+    Everything in a span (start_id to end_id inclusive) is stored, so it needn't be fetched again
+    """
+
+    def __init__(self, file: Pathy = Paths.file_db) -> None:
+        self.file = file
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self.session = 0
+        "Bumped whenever live events may have been missed"
+        self._live: dict[int, tuple[int, int]] = {}
+        "Channel to session and first message seen live in it"
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            syslog.info("Opening message database %s", self.file)
+            self.file.parent.mkdir(exist_ok=True, parents=True)
+            conn = sqlite3.connect(self.file, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def reset_live(self):
+        """Start a new session, events may have been missed so live coverage restarts"""
+        self.session += 1
+
+    def add(self, records: Iterable[dict], session: int | None = None):
+        """Store records. Records seen live in the current session extend the channel's coverage"""
+        live = session is not None and session == self.session
+        rows = []
+        edits = []
+        spans: dict[int, list[int]] = {}
+        for record in records:
+            if record.get("edit"):
+                edits.append(record)
+                continue
+            message_id = record["message_id"]
+            channel_id = record["channel_id"]
+            rows.append(
+                (
+                    message_id,
+                    record["guild_id"],
+                    channel_id,
+                    record["author"]["id"],
+                    record["created_at_ts"],
+                    record.get("edited_at_ts"),
+                    serial.dumps(record).decode("utf-8"),
+                )
+            )
+            if live:
+                span = spans.setdefault(channel_id, [message_id, message_id])
+                span[0] = min(span[0], message_id)
+                span[1] = max(span[1], message_id)
+        if not rows and not edits:
+            return
+
+        with self._lock:
+            conn = self.conn
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+                )
+                for edit in edits:
+                    self._apply_edit(conn, edit)
+                for channel_id, (low, high) in spans.items():
+                    last_session, start = self._live.get(channel_id, (None, low))
+                    if last_session != session:
+                        start = low
+                    start = min(start, low)
+                    self._live[channel_id] = (session, start)
+                    self._cover(conn, channel_id, start, high)
+
+    def _apply_edit(self, conn: sqlite3.Connection, edit: dict):
+        """Fold an edit delta into the stored message, if there is one"""
+        row = conn.execute(
+            "SELECT record FROM messages WHERE message_id = ?", (edit["message_id"],)
+        ).fetchone()
+        if row is None:
+            return
+        record = serial.loads_record(row[0])
+        for key, value in edit.items():
+            if key in ("guild_id", "channel_id", "message_id", "edit"):
+                continue
+            if value or key == "content" or key == "edited_at_ts":
+                record[key] = value
+            else:
+                # emptied attachments/embeds are left out of records
+                record.pop(key, None)
+        conn.execute(
+            "UPDATE messages SET edited_at = ?, record = ? WHERE message_id = ?",
+            (
+                record.get("edited_at_ts"),
+                serial.dumps(record).decode("utf-8"),
+                edit["message_id"],
+            ),
+        )
+
+    def cover(self, channel_id: int, start_id: int, end_id: int):
+        """Mark everything from start_id to end_id as stored"""
+        with self._lock:
+            conn = self.conn
+            with conn:
+                self._cover(conn, channel_id, start_id, end_id)
+
+    def _cover(
+        self, conn: sqlite3.Connection, channel_id: int, start_id: int, end_id: int
+    ):
+        """Merge a span with any it overlaps"""
+        rows = conn.execute(
+            "SELECT rowid, start_id, end_id FROM coverage WHERE channel_id = ? AND end_id >= ? AND start_id <= ?",
+            (channel_id, start_id, end_id),
+        ).fetchall()
+        for rowid, start, end in rows:
+            start_id = min(start_id, start)
+            end_id = max(end_id, end)
+        if rows:
+            conn.executemany(
+                "DELETE FROM coverage WHERE rowid = ?", [(row[0],) for row in rows]
+            )
+        conn.execute(
+            "INSERT INTO coverage VALUES (?, ?, ?)", (channel_id, start_id, end_id)
+        )
+
+    def spans(self, channel_id: int) -> list[tuple[int, int]]:
+        """Coverage of a channel, newest first"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT start_id, end_id FROM coverage WHERE channel_id = ? ORDER BY end_id DESC",
+                (channel_id,),
+            ).fetchall()
+
+    def fetch(
+        self, channel_id: int, before: int, start_id: int, limit: int = 500
+    ) -> list[dict]:
+        """Records of a channel below before, down to start_id inclusive, newest first"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT record FROM messages WHERE channel_id = ? AND message_id < ? AND message_id >= ? ORDER BY message_id DESC LIMIT ?",
+                (channel_id, before, start_id, limit),
+            ).fetchall()
+        return [serial.loads_record(row[0]) for row in rows]
+
+    def edited(
+        self, channel_id: int, since: float, upto: int, limit: int = -1
+    ) -> list[dict]:
+        """Records of a channel up to message upto, edited after since, oldest edit first.
+        All of them unless limit is given"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT record FROM messages WHERE channel_id = ? AND message_id <= ? AND edited_at > ? ORDER BY edited_at LIMIT ?",
+                (channel_id, upto, since, limit),
+            ).fetchall()
+        return [serial.loads_record(row[0]) for row in rows]
+
+    def last_edit(self, channel_id: int, upto: int) -> float | None:
+        """Latest edit to a message of a channel up to message upto"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT MAX(edited_at) FROM messages WHERE channel_id = ? AND message_id <= ?",
+                (channel_id, upto),
+            ).fetchone()
+        return row[0]
+
+    def blobs(self, attachment_ids: Iterable[int]) -> dict[int, str]:
+        """Mirrored blob of each attachment that has one"""
+        ids = list(attachment_ids)
+        found = {}
+        with self._lock:
+            # kept under sqlite's variable limit
+            for start in range(0, len(ids), 500):
+                chunk = ids[start : start + 500]
+                rows = self.conn.execute(
+                    f"SELECT attachment_id, blob FROM blobs WHERE attachment_id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update(rows)
+        return found
+
+    def blob_for(self, sha256: str) -> str | None:
+        """Blob already holding this content, if any"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT blob FROM blobs WHERE sha256 = ? LIMIT 1", (sha256,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def add_blob(self, attachment_id: int, sha256: str, blob: str, size: int):
+        with self._lock:
+            conn = self.conn
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                    (attachment_id, sha256, blob, size),
+                )
+
+    def watermark(self, channel_id: int, fmt: str) -> Watermark | None:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT * FROM watermarks WHERE channel_id = ? AND fmt = ?",
+                (channel_id, fmt),
+            ).fetchone()
+        return Watermark(*row) if row else None
+
+    def set_watermark(self, mark: Watermark):
+        with self._lock:
+            conn = self.conn
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    astuple(mark),
+                )
+
+
+def find_span(spans: list[tuple[int, int]], message_id: int) -> tuple[int, int] | None:
+    """The span containing message_id"""
+    for start, end in spans:
+        if start <= message_id <= end:
+            return (start, end)
+    return None
+
+
+# MIT APasz
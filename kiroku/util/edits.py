@@ -0,0 +1,154 @@
+"""Coalescing of message updates into compact edit records"""
+import asyncio
+import logging
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from .. import SYSLOG, EDIT_DEBOUNCE_SECS, EDIT_CACHE_SIZE
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+EDITABLE = ("content", "attachments", "embeds")
+"Record fields an update can change"
+
+
+def fingerprint(record: dict) -> dict:
+    """What an update has to change to count as an edit, by field.
+    Attachments compare by ID, their URLs are re-signed without the file changing.
+    Fields the record doesn't carry are left out"""
+    prints = {}
+    if "content" in record:
+        prints["content"] = record["content"]
+    if "attachments" in record:
+        prints["attachments"] = tuple(attach["id"] for attach in record["attachments"])
+    if "embeds" in record:
+        prints["embeds"] = tuple(tuple(embed.items()) for embed in record["embeds"])
+    return prints
+
+
+def make_delta(record: dict, base: dict) -> dict | None:
+    """Edit record holding only what changed from base, None if nothing did.
+    Fields missing from record are unchanged, ones missing from base were empty"""
+    old = fingerprint(base)
+    changed = [
+        key
+        for key, after in fingerprint(record).items()
+        if after != old.get(key, None if key == "content" else ())
+    ]
+    if not changed:
+        return None
+
+    delta = {
+        "guild_id": record["guild_id"],
+        "channel_id": record["channel_id"],
+        "message_id": record["message_id"],
+        "edit": True,
+    }
+    if "edited_at_ts" in record:
+        delta["edited_at_ts"] = record["edited_at_ts"]
+    for key in changed:
+        delta[key] = record[key]
+    return delta
+
+
+class Update_Coalescer:
+    """Debounces message updates per message, drops ones that change nothing,
+    and turns the rest into edit deltas against the last known version"""
+
+    def __init__(
+        self,
+        emit: Callable[..., Awaitable[Any]],
+        window: float = EDIT_DEBOUNCE_SECS,
+        size: int = EDIT_CACHE_SIZE,
+    ) -> None:
+        self.emit = emit
+        "Called with log= and record= for each record to write"
+        self.window = window
+        self.size = size
+        self._known: OrderedDict[int, dict] = OrderedDict()
+        self._pending: dict[int, tuple[Any, dict]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.coalesced = 0
+        self.dropped = 0
+        self.edits = 0
+
+    @property
+    def pending(self) -> int:
+        """Updates waiting out their window"""
+        return len(self._pending)
+
+    def seen(self, record: dict):
+        """Remember the editable parts of a message, for diffing later updates"""
+        message_id = record["message_id"]
+        known = self._known.setdefault(message_id, {})
+        # a partial update only replaces what it carries
+        known.update((key, record[key]) for key in EDITABLE if key in record)
+        self._known.move_to_end(message_id)
+        while len(self._known) > self.size:
+            self._known.popitem(last=False)
+
+    def update(self, log: Any, record: dict, old: dict | None = None):
+        """Queue an update, only the latest within the window is kept.
+        old= the message before the update if known, used when it hasn't been seen"""
+        message_id = record["message_id"]
+        if old is not None and message_id not in self._known:
+            self.seen(old)
+
+        if message_id in self._pending:
+            self.coalesced += 1
+            self._pending[message_id] = (log, record)
+            return
+
+        self._pending[message_id] = (log, record)
+        task = asyncio.create_task(self._later(message_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _later(self, message_id: int):
+        await asyncio.sleep(self.window)
+        await self.flush(message_id)
+
+    async def flush(self, message_id: int):
+        """Write the pending update for a message"""
+        pending = self._pending.pop(message_id, None)
+        if pending is None:
+            return
+        log, record = pending
+
+        base = self._known.get(message_id)
+        if base is None and all(key in record for key in ("author", *EDITABLE)):
+            # never seen the original, so keep the whole message
+            out = record
+        else:
+            # a partial update of an unseen message can only be kept as an edit
+            out = make_delta(record, base or {})
+            if out is None:
+                self.dropped += 1
+                syslog.debug("Dropped no-op update %s", message_id)
+                return
+        self.edits += 1
+        self.seen(record)
+
+        try:
+            await self.emit(log=log, record=out)
+        except Exception:
+            syslog.exception("Emit edit %s", message_id)
+
+    async def flush_all(self):
+        """Write everything pending now, for shutdown"""
+        for task in list(self._tasks):
+            task.cancel()
+        for message_id in list(self._pending):
+            await self.flush(message_id)
+        syslog.info(
+            "Edits %s, coalesced %s, dropped %s",
+            self.edits,
+            self.coalesced,
+            self.dropped,
+        )
+
+
+# MIT APasz
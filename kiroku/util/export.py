@@ -0,0 +1,133 @@
+"""Streaming rendered messages into an export file"""
+import logging
+import os
+from collections.abc import Iterable
+from pathlib import Path as Pathy
+from typing import Any, BinaryIO
+
+from .. import SYSLOG
+from ..util import serial
+from ..util.render import Renderer, record_key
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+TOTAL_WIDTH = 12
+"Characters reserved in the header for the message total"
+PLACEHOLDER = 10 ** (TOTAL_WIDTH - 1)
+"Stands in for the total until it's known, exactly TOTAL_WIDTH digits"
+BASE_KEYS = ("guild_id", "channel_id", "total_messages")
+
+
+class Export_Writer:
+    """Writes rendered messages to a file as they come, so memory stays flat however many there are.
+    The header reserves room for the total, which is filled in on close"""
+
+    def __init__(
+        self,
+        file: Pathy,
+        renderer: Renderer,
+        head: dict,
+        offset: int | None = None,
+        total: int = 0,
+    ) -> None:
+        """offset= resume a partial file from a checkpoint, anything after it is discarded.
+        total= messages already in the file at offset"""
+        self.file = file
+        self.renderer = renderer
+        self.layout = renderer.layout
+        self.head = dict(head)
+        self.offset = offset
+        self.total = total
+        self._f: BinaryIO | None = None
+        self._total_at = 0
+
+    def __enter__(self) -> "Export_Writer":
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # left unfinished on error, so it can be resumed from the last checkpoint
+        self.close(finish=exc_type is None)
+
+    def open(self):
+        header = self._header()
+        if self.offset and self.file.exists():
+            self._f = open(self.file, "r+b")
+            self._f.truncate(self.offset)
+            self._f.seek(self.offset)
+            return
+        self.total = 0
+        self.file.parent.mkdir(exist_ok=True, parents=True)
+        self._f = open(self.file, "wb")
+        self._f.write(header)
+
+    def _header(self) -> bytes:
+        """Header with the placeholder total, remembering where it sits"""
+        head = self.head
+        head["total_messages"] = PLACEHOLDER
+        if self.layout == "TEXT":
+            prefix = f"Guild ID: {head['guild_id']} | Channel ID: {head['channel_id']} | Total Messages: "
+            header = f"{prefix}{PLACEHOLDER}"
+            notes = [
+                f"{key.replace('_', ' ').title()}: {value}"
+                for key, value in head.items()
+                if key not in BASE_KEYS
+            ]
+            if notes:
+                header += "\n" + " | ".join(notes) + "\n"
+            self._total_at = len(prefix.encode())
+            return header.encode()
+
+        if self.layout == "LINES":
+            header = serial.dumps(head) + b"\n"
+        else:
+            header = b"{" + serial.dumps_pretty(head)[1:-2]
+        key = header.index(b'"total_messages":')
+        self._total_at = header.index(str(PLACEHOLDER).encode(), key)
+        return header
+
+    def write(self, record: dict, rendered: Any):
+        """Add a rendered message, record is what it was rendered from"""
+        f = self._f
+        if self.layout == "TEXT":
+            f.write(b"\n" + rendered.encode())
+        elif self.layout == "LINES":
+            f.write(rendered + b"\n")
+        else:
+            entry = serial.dumps_pretty({record_key(record): rendered})
+            f.write(b",\n" + entry[2:-2])
+        self.total += 1
+
+    def write_many(self, records: Iterable[dict], rendered: Iterable[Any]):
+        for record, out in zip(records, rendered):
+            self.write(record, out)
+
+    def checkpoint(self) -> int:
+        """Flush to disk, returns the offset to resume from"""
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.offset = self._f.tell()
+        return self.offset
+
+    def close(self, finish: bool = True):
+        """Finish the file and fill in the total, finish=False only closes it"""
+        f = self._f
+        if f is None:
+            return
+        self._f = None
+        if not finish:
+            f.close()
+            return
+        try:
+            if self.layout == "OBJECT":
+                f.write(b"\n}")
+            f.seek(self._total_at)
+            f.write(f"{self.total:<{TOTAL_WIDTH}}".encode())
+            self.head["total_messages"] = self.total
+        finally:
+            f.close()
+
+
+# MIT APasz
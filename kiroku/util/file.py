@@ -1,9 +1,18 @@
+import asyncio
+import functools
 import logging
 import json as JSON
 import math
+import os
+import secrets
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path as Pathy
+from typing import Any
 
-from .. import SYSLOG
+from .. import SYSLOG, IO_WORKERS, JSON_CACHE_ENTRIES, JSON_CACHE_MB
 
 print(__name__)
 
@@ -27,16 +36,57 @@ class Paths:
     data.mkdir(exist_ok=True)
     util = project.joinpath("util")
     util.mkdir(exist_ok=True)
+    jobs = data.joinpath("jobs")
+    blobs = data.joinpath("blobs")
+    zips = data.joinpath("zips")
+    manifests = data.joinpath("manifests")
     dump = work.joinpath("dump")
 
     file_bot = project.joinpath("bot.py")
     file_cache_json = dump.joinpath("cache.json")
+    file_db = data.joinpath("messages.sqlite3")
+    file_zones = data.joinpath("timezones.json")
+    file_metrics = data.joinpath("metrics.prom")
 
 
-class Read_Write:
-    """For your reading and writing needs"""
+_io_executor: ThreadPoolExecutor | None = None
+
+
+def io_executor() -> ThreadPoolExecutor:
+    """Threads file IO is run on, so however much is asked for only IO_WORKERS run at once"""
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(
+            max_workers=max(1, IO_WORKERS), thread_name_prefix="kiroku_io"
+        )
+    return _io_executor
+
 
-    cache_json = {}
+async def run_io(func: Callable, *args, **kwargs) -> Any:
+    """Run blocking file IO on the IO executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        io_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+class Read_Write:
+    """For your reading and writing needs.
+    Files are written to a temporary file beside them and swapped in, so a crash never leaves one half written
+    """
+
+    cache_json: OrderedDict[str, dict] = OrderedDict()
+    "Parsed JSON files by path, least recently read first"
+    cache_entries = JSON_CACHE_ENTRIES
+    cache_size = int(JSON_CACHE_MB * 1024 * 1024)
+    "In bytes, of the files as they are on disk"
+    cache_bytes = 0
+    cache_hits = 0
+    cache_misses = 0
+    cache_evictions = 0
+    _cache_lock = threading.Lock()
+    _folders: set[Pathy] = set()
+    "Folders already made, so each is only made once"
 
     @classmethod
     def check_ext(cls, filename: Pathy | str, ext: str) -> Pathy:
@@ -49,8 +99,39 @@ class Read_Write:
         return filename
 
     @classmethod
-    def write_json(cls, data: dict, file: Pathy, sort=False) -> bool:
-        """Create a JSON file containing data."""
+    def _mkdir(cls, folder: Pathy):
+        if folder not in cls._folders:
+            folder.mkdir(exist_ok=True, parents=True)
+            cls._folders.add(folder)
+
+    @classmethod
+    def _replace(cls, data: bytes, file: Pathy, fsync: bool = False):
+        """Write data to a temporary file beside file, then swap it in"""
+        part = file.with_name(f"{file.name}.{secrets.token_hex(4)}.part")
+        try:
+            try:
+                f = open(part, "xb")
+            except FileNotFoundError:
+                # removed since it was made
+                cls._folders.discard(file.parent)
+                cls._mkdir(file.parent)
+                f = open(part, "xb")
+            with f:
+                f.write(data)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(part, file)
+        except BaseException:
+            part.unlink(missing_ok=True)
+            raise
+
+    @classmethod
+    def write_json(
+        cls, data: dict, file: Pathy, sort=False, fsync: bool = False
+    ) -> bool:
+        """Create a JSON file containing data.
+        fsync= make sure it's on disk before returning"""
         syslog.debug("write file=%s", file)
 
         file = cls.check_ext(filename=file, ext=".json")
@@ -61,29 +142,82 @@ class Read_Write:
         if file.exists():
             syslog.debug("Exists: file=%s", file)
 
-        file.parent.mkdir(exist_ok=True, parents=True)
+        cls._mkdir(file.parent)
 
-        mode = "w"
+        try:
+            text = JSON.dumps(
+                obj=data,
+                indent=4,
+                separators=(", ", ": "),
+                sort_keys=sort,
+            )
+            cls._replace(data=text.encode("UTF-8"), file=file, fsync=fsync)
+        except Exception:
+            syslog.exception("write_json")
+            return False
+        return True
 
-        with open(file, mode, encoding="UTF-8") as f:
-            try:
-                JSON.dump(
-                    obj=data,
-                    fp=f,
-                    indent=4,
-                    separators=(", ", ": "),
-                    sort_keys=sort,
-                )
-            except Exception:
-                syslog.exception("write_json")
-                return False
-            return True
+    @classmethod
+    async def write_json_async(
+        cls, data: dict, file: Pathy, sort=False, fsync: bool = False
+    ) -> bool:
+        """write_json on the IO executor"""
+        return await run_io(
+            cls.write_json, data=data, file=file, sort=sort, fsync=fsync
+        )
 
     @classmethod
     def write_cache(cls) -> bool:
         """Dump the current cache_json to file"""
         syslog.warning("Dumping cache_json")
-        return cls.write_json(data=cls.cache_json, file=Paths.file_cache_json)
+        with cls._cache_lock:
+            data = dict(cls.cache_json)
+        return cls.write_json(data=data, file=Paths.file_cache_json)
+
+    @classmethod
+    def load_cache(cls) -> int:
+        """Warm the cache from the last write_cache, entries whose file has since changed are left out.
+        Returns number loaded"""
+        if not Paths.file_cache_json.exists():
+            return 0
+        data = cls._read(fp=Paths.file_cache_json)
+        if not isinstance(data, dict):
+            return 0
+        loaded = 0
+        # oldest first, so the most recently read end up most recent again
+        for key, meta in data.items():
+            try:
+                stat = cls._cache_file(key).stat()
+                if (meta["mtime_ns"], meta["size"]) != (stat.st_mtime_ns, stat.st_size):
+                    continue
+                cls._cache_add(key=key, stat=stat, data=meta["content"])
+            except (OSError, KeyError, TypeError):
+                continue
+            loaded += 1
+        syslog.info("Loaded %s of %s cached JSON files", loaded, len(data))
+        return loaded
+
+    @classmethod
+    def cache_stats(cls) -> dict:
+        return {
+            "entries": len(cls.cache_json),
+            "bytes": cls.cache_bytes,
+            "hits": cls.cache_hits,
+            "misses": cls.cache_misses,
+            "evictions": cls.cache_evictions,
+        }
+
+    @classmethod
+    def _cache_key(cls, file: Pathy) -> str:
+        """Files under work by their path from it, so the dump survives the bot moving"""
+        try:
+            return file.relative_to(Paths.work).as_posix()
+        except ValueError:
+            return file.as_posix()
+
+    @classmethod
+    def _cache_file(cls, key: str) -> Pathy:
+        return Paths.work.joinpath(key)
 
     @classmethod
     def _read(cls, fp: Pathy) -> dict | bool:
@@ -96,21 +230,40 @@ class Read_Write:
             return False
 
     @classmethod
-    def _cache_add(cls, file_rel: Pathy, mod_time: int, data: dict):
-        """Add data to cache"""
-        meta = {"mod_time": mod_time, "content": data}
-        cls.cache_json[file_rel] = meta
+    def _cache_add(cls, key: str, stat: os.stat_result, data: dict):
+        """Add data to cache, dropping the least recently read while over either limit"""
+        if stat.st_size > cls.cache_size:
+            return
+        meta = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "content": data}
+        with cls._cache_lock:
+            if old := cls.cache_json.pop(key, None):
+                cls.cache_bytes -= old["size"]
+            cls.cache_json[key] = meta
+            cls.cache_bytes += stat.st_size
+            while (
+                len(cls.cache_json) > cls.cache_entries
+                or cls.cache_bytes > cls.cache_size
+            ):
+                _, old = cls.cache_json.popitem(last=False)
+                cls.cache_bytes -= old["size"]
+                cls.cache_evictions += 1
 
     @classmethod
-    def _cache_check(cls, file: Pathy, mod_time: int):
-        """Check if file in cache, return data if so"""
-        new_mod_time = int(file.stat().st_mtime)
-        file_relative = file.absolute().relative_to(Paths.work)
-        if file_relative in cls.cache_json:
-            old_mod_time = cls.cache_json[file_relative]["mod_time"]
-            if old_mod_time == new_mod_time:
-                return cls.cache_json[file_relative]["content"]
-        return False
+    def _cache_check(cls, key: str, stat: os.stat_result) -> dict | None:
+        """Cached data of a file, None if not cached or the file has changed since"""
+        with cls._cache_lock:
+            meta = cls.cache_json.get(key)
+            if meta is None:
+                cls.cache_misses += 1
+                return None
+            if (meta["mtime_ns"], meta["size"]) != (stat.st_mtime_ns, stat.st_size):
+                del cls.cache_json[key]
+                cls.cache_bytes -= meta["size"]
+                cls.cache_misses += 1
+                return None
+            cls.cache_json.move_to_end(key)
+            cls.cache_hits += 1
+            return meta["content"]
 
     @classmethod
     def read_json(
@@ -119,11 +272,10 @@ class Read_Write:
         """Read JSON file."""
         syslog.debug("read file=%s", file)
 
-        file = cls.check_ext(filename=file)
+        file = cls.check_ext(filename=file, ext=".json")
 
-        file_relative = file.absolute().relative_to(Paths.work)
         if not file.exists():
-            syslog.warning("File not Found %s", file_relative)
+            syslog.warning("File not Found %s", cls._cache_key(file))
             if create:
                 syslog.warning("Creating")
                 Read_Write.write_json(data={}, file=file)
@@ -133,17 +285,47 @@ class Read_Write:
         if not cache:
             return cls._read(fp=file)
 
-        new_mod_time = int(file.stat().st_mtime)
-        if data := cls._cache_check(file=file_relative, mod_time=new_mod_time):
-            pass
-        else:
+        key = cls._cache_key(file)
+        stat = file.stat()
+        data = cls._cache_check(key=key, stat=stat)
+        if data is None:
             data = cls._read(fp=file)
-            cls._cache_add(file_rel=file_relative, mod_time=new_mod_time, data=data)
+            if data is not False:
+                cls._cache_add(key=key, stat=stat, data=data)
         return data
 
     @classmethod
-    def write_txt(cls, data: str, file: Pathy, mode: str = "w"):
-        """Create a TXT file containing data."""
+    def write_bytes(
+        cls, data: bytes, file: Pathy, ext: str, fsync: bool = False
+    ) -> bool:
+        """Create a file containing already encoded data."""
+        syslog.debug("write file=%s", file)
+
+        file = cls.check_ext(filename=file, ext=ext)
+
+        if not isinstance(data, bytes):
+            raise TypeError
+
+        cls._mkdir(file.parent)
+
+        try:
+            cls._replace(data=data, file=file, fsync=fsync)
+        except Exception:
+            syslog.exception("write_bytes")
+            return False
+        return True
+
+    @classmethod
+    async def write_bytes_async(
+        cls, data: bytes, file: Pathy, ext: str, fsync: bool = False
+    ) -> bool:
+        """write_bytes on the IO executor"""
+        return await run_io(cls.write_bytes, data=data, file=file, ext=ext, fsync=fsync)
+
+    @classmethod
+    def write_txt(cls, data: str, file: Pathy, mode: str = "w", fsync: bool = False):
+        """Create a TXT file containing data.
+        mode="a" appends in place, anything else replaces the file whole"""
         syslog.debug("write file=%s", file)
 
         file = cls.check_ext(filename=file, ext=".txt")
@@ -154,15 +336,28 @@ class Read_Write:
         if file.exists():
             syslog.debug("Exists: file=%s", file)
 
-        file.parent.mkdir(exist_ok=True, parents=True)
+        cls._mkdir(file.parent)
 
-        with open(file, mode, encoding="UTF-8") as f:
-            try:
+        try:
+            if mode != "a":
+                cls._replace(data=data.encode("UTF-8"), file=file, fsync=fsync)
+                return True
+            with open(file, mode, encoding="UTF-8") as f:
                 f.write(data)
-            except Exception:
-                syslog.exception("write_txt")
-                return False
-            return True
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except Exception:
+            syslog.exception("write_txt")
+            return False
+        return True
+
+    @classmethod
+    async def write_txt_async(
+        cls, data: str, file: Pathy, mode: str = "w", fsync: bool = False
+    ) -> bool:
+        """write_txt on the IO executor"""
+        return await run_io(cls.write_txt, data=data, file=file, mode=mode, fsync=fsync)
 
 
 def bytes_magnitude(byte_num: int, magnitude: str, bi: bool) -> float:
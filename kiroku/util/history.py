@@ -0,0 +1,214 @@
+"""Walking a channel's history, from the local database where it can"""
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator, Sequence
+
+import hikari
+
+from .. import SYSLOG
+from ..store import Store
+from ..util.budget import Rate_Budget
+from ..util.database import find_span
+from ..util.members import Member_Resolver
+from ..util.metrics import REST_PAGE_SECONDS, REST_PAGES
+from ..util.message import nice_message
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+
+async def chunk_records(
+    chunk: Sequence[hikari.Message],
+    guild: hikari.Guild,
+    chan: hikari.TextableChannel,
+    resolver: Member_Resolver,
+) -> list[dict | None]:
+    """Records of a chunk of messages, their authors looked up together.
+    None in place of a message that couldn't be recorded, so it isn't covered as stored
+    """
+    await resolver.prefetch(chunk)
+    records = []
+    for message in chunk:
+        mem = await resolver.resolve(message)
+        try:
+            mess = nice_message(
+                mess_obj=message,
+                memb_obj=mem,
+                chan_obj=chan,
+                guil_obj=guild,
+            )
+            records.append(mess.recordise())
+        except Exception:
+            syslog.exception("Retrieval error")
+            records.append(None)
+    return records
+
+
+def edit_record(record: dict) -> dict:
+    """Edit record carrying the current state of a stored message"""
+    edit = {
+        "guild_id": record["guild_id"],
+        "channel_id": record["channel_id"],
+        "message_id": record["message_id"],
+        "edit": True,
+        "edited_at_ts": record["edited_at_ts"],
+        "content": record.get("content"),
+    }
+    for key in ("attachments", "embeds"):
+        if record.get(key):
+            edit[key] = record[key]
+    return edit
+
+
+async def history_records(
+    app: hikari.RESTAware,
+    guild: hikari.Guild,
+    chan: hikari.TextableChannel,
+    resolver: Member_Resolver | None = None,
+    before: int | None = None,
+    budget: Rate_Budget | None = None,
+) -> AsyncIterator[dict]:
+    """Records of a channel newest first, starting below before if given.
+    Spans the local database already has are read from it, only the gaps are fetched over REST.
+    budget= taken from for each page fetched
+    """
+    resolver = resolver or Member_Resolver(app=app, guild=guild)
+    db = Store.database
+    spans = await asyncio.to_thread(db.spans, chan.id)
+    joined = False
+
+    while True:
+        span = None
+        hit = None
+        first = last = None
+        exhausted = False
+        page = []
+        try:
+            history = chan.fetch_history(
+                before=hikari.UNDEFINED if before is None else before
+            )
+            # pages are fetched as the chunks are asked for
+            if budget:
+                await budget.take()
+            asked = time.monotonic()
+            async for chunk in history.chunk(100):
+                REST_PAGES.inc()
+                REST_PAGE_SECONDS.observe(time.monotonic() - asked)
+                # only messages before a stored span are needed
+                for i, message in enumerate(chunk):
+                    if span := find_span(spans, message.id):
+                        hit = int(message.id)
+                        chunk = chunk[:i]
+                        break
+
+                for record in await chunk_records(chunk, guild, chan, resolver):
+                    if record is None:
+                        # coverage can't run across it, what's above is covered on its own
+                        if page:
+                            await asyncio.to_thread(db.add, page)
+                            page = []
+                        high = before if joined else first
+                        if high is not None and last is not None:
+                            await asyncio.to_thread(db.cover, chan.id, last, high)
+                        first = last = None
+                        joined = False
+                        continue
+                    first = first or record["message_id"]
+                    last = record["message_id"]
+                    page.append(record)
+                    if len(page) >= 100:
+                        await asyncio.to_thread(db.add, page)
+                        page = []
+                    yield record
+
+                if span:
+                    break
+                if budget:
+                    await budget.take()
+                asked = time.monotonic()
+            else:
+                exhausted = True
+        finally:
+            if page:
+                await asyncio.to_thread(db.add, page)
+            # everything from where this run started to where it stopped is now stored,
+            # after a span, before is the start of it so the two join up
+            high = before if joined else first
+            if span:
+                low = span[0]
+            elif exhausted:
+                low = 0
+            else:
+                low = last
+            if high is not None and low is not None:
+                await asyncio.to_thread(db.cover, chan.id, low, high)
+
+        if span is None:
+            return
+
+        syslog.debug("Reading %s from database", span)
+        upper = hit + 1
+        while rows := await asyncio.to_thread(db.fetch, chan.id, upper, span[0]):
+            for record in rows:
+                yield record
+            upper = rows[-1]["message_id"]
+        if span[0] == 0:
+            # span reaches the start of the channel
+            return
+        before = span[0]
+        joined = True
+
+
+async def newer_records(
+    app: hikari.RESTAware,
+    guild: hikari.Guild,
+    chan: hikari.TextableChannel,
+    after: int,
+    resolver: Member_Resolver | None = None,
+    budget: Rate_Budget | None = None,
+) -> AsyncIterator[dict]:
+    """Records of a channel newer than after, oldest first.
+    What's fetched is stored, and covered as it comes in one unbroken run
+    """
+    resolver = resolver or Member_Resolver(app=app, guild=guild)
+    db = Store.database
+    first = last = None
+    page = []
+    try:
+        history = chan.fetch_history(after=after)
+        if budget:
+            await budget.take()
+        asked = time.monotonic()
+        async for chunk in history.chunk(100):
+            REST_PAGES.inc()
+            REST_PAGE_SECONDS.observe(time.monotonic() - asked)
+            for record in await chunk_records(chunk, guild, chan, resolver):
+                if record is None:
+                    # coverage can't run across it, what's below is covered on its own
+                    if page:
+                        await asyncio.to_thread(db.add, page)
+                        page = []
+                    if first is not None:
+                        await asyncio.to_thread(db.cover, chan.id, first, last)
+                    first = last = None
+                    continue
+                first = first or record["message_id"]
+                last = record["message_id"]
+                page.append(record)
+                if len(page) >= 100:
+                    await asyncio.to_thread(db.add, page)
+                    page = []
+                yield record
+            if budget:
+                await budget.take()
+            asked = time.monotonic()
+    finally:
+        if page:
+            await asyncio.to_thread(db.add, page)
+        if first is not None:
+            await asyncio.to_thread(db.cover, chan.id, first, last)
+
+
+# MIT APasz
@@ -0,0 +1,370 @@
+"""Retrieves run as background jobs, checkpointed to disk so they survive restarts"""
+import asyncio
+import functools
+import logging
+import secrets
+import time
+from contextlib import aclosing
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path as Pathy
+
+import hikari
+
+from .. import SYSLOG, JOB_CONCURRENCY, JOB_CHECKPOINT_SECS
+from ..util.export import Export_Writer
+from ..util.file import Paths, Read_Write, run_io
+from ..store import Store
+from ..util.database import Watermark
+from ..util.history import edit_record, history_records, newer_records
+from ..util.members import Member_Resolver
+from ..util.metrics import RETRIEVED
+from ..util.profiler import profiled, profiler
+from ..util.render import get_renderer, render_many, snowflake_ts, ts_snowflake
+from ..util.timefmt import Zones
+from ..util.upload import send_file
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+JOB_KEEP_SECS = 86400
+"In seconds, how long finished jobs are kept for checking on"
+
+
+def new_job_id() -> str:
+    """Short enough to type into /job"""
+    return secrets.token_hex(4)
+
+
+@dataclass(slots=True)
+class Retrieve_Job:
+    """A retrieve, as saved in its checkpoint file"""
+
+    job_id: str
+    guild_id: int
+    channel_id: int
+    requester_id: int
+    fmt: str
+    file: str
+    "Output file"
+    limit: int | None = None
+    from_ts: float | None = None
+    from_date: str | None = None
+    "As given, for the output header"
+    to_ts: float | None = None
+    to_date: str | None = None
+    state: str = "QUEUED"
+    "QUEUED | RUNNING | DONE | FAILED"
+    before: int | None = None
+    "Last message written as of the checkpoint, the walk carries on below it"
+    written: int = 0
+    offset: int | None = None
+    "Size of the output as of the checkpoint"
+    incremental: bool = False
+    "Append messages newer than the channel's watermark to its standing export, oldest first"
+    after: int | None = None
+    "Incremental, newest message written as of the checkpoint, the walk carries on above it"
+    mark: int | None = None
+    "Incremental, newest message in the export before this job, edits up to it are appended"
+    edited_since: float = 0
+    "Incremental, latest edit in the export before this job"
+    base: int = 0
+    "Incremental, messages in the export before this job"
+    error: str | None = None
+    created: float = field(default_factory=time.time)
+    updated: float = field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ("DONE", "FAILED")
+
+    def head(self) -> dict:
+        """Output header, the same every time the job is resumed"""
+        head = {
+            "guild_id": self.guild_id,
+            "channel_id": self.channel_id,
+            "total_messages": 0,
+        }
+        if self.incremental:
+            head["incremental"] = True
+        if self.limit:
+            head["limit"] = self.limit
+        if self.from_date:
+            head["from_date"] = self.from_date
+        if self.to_date:
+            head["to_date"] = self.to_date
+        return head
+
+    def describe(self) -> str:
+        text = f"`{self.job_id}` {self.state} | <#{self.channel_id}> | {self.fmt} | {self.written} messages"
+        if self.before and not self.finished:
+            reached = Zones.get(self.guild_id).format(snowflake_ts(self.before))
+            text += f" | back to {reached}"
+        if self.error:
+            text += f" | {self.error}"
+        return text
+
+
+class Job_Manager:
+    """Runs retrieve jobs in the background and picks unfinished ones back up on start"""
+
+    def __init__(
+        self,
+        folder: Pathy = Paths.jobs,
+        concurrency: int = JOB_CONCURRENCY,
+        checkpoint_secs: float = JOB_CHECKPOINT_SECS,
+    ) -> None:
+        self.folder = folder
+        self.concurrency = concurrency
+        self.checkpoint_secs = checkpoint_secs
+        self.jobs: dict[str, Retrieve_Job] = {}
+        self.app: hikari.GatewayBot | None = None
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._limit: asyncio.Semaphore | None = None
+
+    @property
+    def running(self) -> int:
+        """Jobs running or waiting their turn"""
+        return len(self._tasks)
+
+    def start(self, app: hikari.GatewayBot):
+        """Resume whatever was unfinished when the bot last stopped"""
+        self.app = app
+        self._limit = asyncio.Semaphore(self.concurrency)
+        for job in self.load():
+            if not job.finished:
+                syslog.info("Resuming job %s", job.job_id)
+                self._launch(job)
+
+    async def stop(self):
+        """Stop running jobs, they checkpoint and resume on next start"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def path(self, job: Retrieve_Job) -> Pathy:
+        return self.folder.joinpath(f"{job.job_id}.json")
+
+    def load(self) -> list[Retrieve_Job]:
+        """Read saved jobs, dropping finished ones past JOB_KEEP_SECS"""
+        names = {f.name for f in fields(Retrieve_Job)}
+        self.folder.mkdir(exist_ok=True, parents=True)
+        for file in self.folder.glob("*.json"):
+            data = Read_Write.read_json(file=file, cache=False)
+            if not data:
+                continue
+            try:
+                job = Retrieve_Job(**{k: v for k, v in data.items() if k in names})
+            except TypeError:
+                syslog.exception("Job file %s", file.name)
+                continue
+            if job.finished and time.time() - job.updated > JOB_KEEP_SECS:
+                file.unlink(missing_ok=True)
+                continue
+            self.jobs[job.job_id] = job
+        return list(self.jobs.values())
+
+    def save(self, job: Retrieve_Job):
+        job.updated = time.time()
+        Read_Write.write_json(data=asdict(job), file=self.path(job))
+
+    def get(self, job_id: str) -> Retrieve_Job | None:
+        return self.jobs.get(job_id)
+
+    def for_guild(self, guild_id: int) -> list[Retrieve_Job]:
+        """Jobs of a guild, newest first"""
+        jobs = [job for job in self.jobs.values() if job.guild_id == guild_id]
+        return sorted(jobs, key=lambda job: job.created, reverse=True)
+
+    def submit(self, job: Retrieve_Job):
+        self.jobs[job.job_id] = job
+        self.save(job)
+        self._launch(job)
+
+    def _launch(self, job: Retrieve_Job):
+        task = asyncio.create_task(self._run(job), name=f"job_{job.job_id}")
+        self._tasks[job.job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job.job_id, None))
+
+    async def _run(self, job: Retrieve_Job):
+        async with self._limit:
+            job.state = "RUNNING"
+            await run_io(self.save, job)
+            try:
+                await self._retrieve(job)
+            except asyncio.CancelledError:
+                # still RUNNING on disk, so it's resumed next start
+                raise
+            except Exception as e:
+                syslog.exception("Job %s", job.job_id)
+                job.state = "FAILED"
+                job.error = str(e) or type(e).__name__
+                await run_io(self.save, job)
+                await self._post(job, f"Retrieve `{job.job_id}` failed: {job.error}")
+                return
+            job.state = "DONE"
+            await run_io(self.save, job)
+        content = f"Message archive, {job.written} messages"
+        if job.incremental:
+            content += f", {job.written - job.base} new"
+        await self._post(job, content, file=Pathy(job.file))
+
+    @profiled("retrieve")
+    async def _retrieve(self, job: Retrieve_Job):
+        app = self.app
+        guild = app.cache.get_guild(job.guild_id) or await app.rest.fetch_guild(
+            job.guild_id
+        )
+        chan = app.cache.get_guild_channel(
+            job.channel_id
+        ) or await app.rest.fetch_channel(job.channel_id)
+
+        output = Pathy(job.file)
+        size = output.stat().st_size if output.exists() else 0
+        if job.offset and size < job.offset:
+            # what was written up to the checkpoint is gone, carrying on would leave it out
+            if job.incremental:
+                raise RuntimeError(
+                    "Archive being appended to has gone, retrieve again for a new one"
+                )
+            syslog.warning("Job %s output has gone, starting over", job.job_id)
+            job.before = ts_snowflake(job.to_ts) if job.to_ts else None
+            job.written = 0
+            job.offset = None
+
+        renderer = get_renderer(job.fmt)
+        tf = Zones.get(guild.id)
+        resolver = Member_Resolver(app=app, guild=guild)
+        remaining = job.limit - job.written if job.limit else None
+        floor = ts_snowflake(job.from_ts) if job.from_ts and not job.incremental else 0
+        batch = []
+        last = job.after if job.incremental else job.before
+        saved = time.monotonic()
+
+        writer = Export_Writer(
+            file=output,
+            renderer=renderer,
+            head=job.head(),
+            offset=job.offset,
+            total=job.written,
+        )
+
+        def checkpoint():
+            """Output and job file agree on where things are up to"""
+            job.offset = writer.checkpoint()
+            job.written = writer.total
+            if job.incremental:
+                job.after = last
+            else:
+                job.before = last
+            self.save(job)
+
+        pending: asyncio.Future | None = None
+
+        async def io(func, *args):
+            """Off the loop, carried through even if the job is stopped meanwhile"""
+            nonlocal pending
+            pending = asyncio.ensure_future(
+                run_io(profiler.call, "retrieve", func, *args)
+            )
+            await asyncio.shield(pending)
+
+        async def flush():
+            nonlocal last, saved
+            if Store.mirror.retrieve:
+                await Store.mirror.mirror(batch)
+            records = list(batch)
+            batch.clear()
+            rendered = render_many(records, renderer.render, tf)
+            # the write finishes regardless, so last goes with it
+            last = records[-1]["message_id"]
+            await io(writer.write_many, records, rendered)
+            RETRIEVED.inc(len(records))
+            if time.monotonic() - saved >= self.checkpoint_secs:
+                await io(checkpoint)
+                saved = time.monotonic()
+
+        db = Store.database
+        with writer:
+            if job.incremental:
+                history = newer_records(
+                    app, guild, chan, after=job.after or 0, resolver=resolver
+                )
+            else:
+                history = history_records(
+                    app, guild, chan, resolver=resolver, before=job.before
+                )
+            try:
+                async with aclosing(history) as history:
+                    async for record in history:
+                        if remaining is not None:
+                            if remaining <= 0:
+                                syslog.info("reached message limit")
+                                break
+                            remaining -= 1
+
+                        if record["message_id"] < floor:
+                            syslog.info("reached from_date limit")
+                            break
+
+                        batch.append(record)
+                        if len(batch) >= 100:
+                            await flush()
+                if batch:
+                    await flush()
+                if job.incremental and job.mark:
+                    edited = await asyncio.to_thread(
+                        db.edited, chan.id, job.edited_since, job.mark
+                    )
+            except BaseException:
+                if pending is not None and not pending.done():
+                    await asyncio.wait([pending])
+                # whatever was still batched gets fetched again on resume
+                checkpoint()
+                raise
+
+            if job.incremental:
+                # nothing awaited from here, so edits can't be half written when stopped
+                if job.mark:
+                    edits = [edit_record(record) for record in edited]
+                    writer.write_many(edits, render_many(edits, renderer.render, tf))
+                checkpoint()
+            job.written = writer.total
+
+        if job.incremental and last:
+            latest = await asyncio.to_thread(db.last_edit, chan.id, last)
+            mark = Watermark(
+                channel_id=job.channel_id,
+                fmt=job.fmt,
+                file=job.file,
+                message_id=last,
+                edited_at=max(latest or 0, job.edited_since) or None,
+                total=job.written,
+                offset=job.offset,
+            )
+            await asyncio.to_thread(db.set_watermark, mark)
+
+        syslog.info(
+            "Job %s retrieved %s messages, %s", job.job_id, job.written, resolver
+        )
+
+    async def _post(self, job: Retrieve_Job, content: str, file: Pathy | None = None):
+        """Let the requester know, the interaction may be long gone so this goes to the channel"""
+        send = functools.partial(
+            self.app.rest.create_message,
+            job.channel_id,
+            user_mentions=[job.requester_id],
+        )
+        content = f"<@{job.requester_id}> {content}"
+        try:
+            if file is None:
+                await send(content)
+            else:
+                guild = self.app.cache.get_guild(job.guild_id)
+                await send_file(send, file=file, content=content, guild=guild)
+        except Exception:
+            syslog.exception("Posting job %s", job.job_id)
+
+
+# MIT APasz
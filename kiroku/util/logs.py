@@ -0,0 +1,256 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from pathlib import Path as Pathy
+from typing import BinaryIO
+
+from .. import SYSLOG, ARCHIVE_FORMAT, MAX_OPEN_LOGS, LOG_IDLE_SECS, MESS_SIZE
+from ..util.archive import Archive_Format, get_format
+from ..util.file import Paths
+from ..util.manifest import Channel_Manifest, Segment_Entry
+from ..util.segments import next_segment
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+
+def find_log_path(
+    guild_id: int, channel_id: int, guild_name: str, channel_name: str, ext: str
+) -> Pathy:
+    """Find the log file for a channel by ID, so renamed guilds/channels keep their file"""
+    guild_folder = next(Paths.logs.glob(f"*_({guild_id})"), None)
+    if guild_folder is None:
+        guild_folder = Paths.logs.joinpath(f"{guild_name}_({guild_id})")
+
+    log_file = next(guild_folder.glob(f"*_({channel_id}){ext}"), None)
+    if log_file is None:
+        log_file = guild_folder.joinpath(f"{channel_name}_({channel_id}){ext}")
+    return log_file
+
+
+class Channel_Log:
+    """Lazily opened log file for a single channel"""
+
+    __slots__ = (
+        "registry",
+        "guild_id",
+        "channel_id",
+        "guild_name",
+        "channel_name",
+        "path",
+        "last_used",
+        "index",
+        "_stream",
+        "_lock",
+    )
+
+    def __init__(
+        self,
+        registry: "Log_Registry",
+        guild_id: int,
+        channel_id: int,
+        guild_name: str,
+        channel_name: str,
+    ) -> None:
+        self.registry = registry
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.guild_name = guild_name
+        self.channel_name = channel_name
+        self.path: Pathy | None = None
+        self.last_used = time.monotonic()
+        self.index: Segment_Entry | None = None
+        "Manifest entry of the active file"
+        self._stream: BinaryIO | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._stream is not None
+
+    def _open(self) -> BinaryIO:
+        """Open the file for appending, resolving its path on first use"""
+        if self.path is None:
+            self.path = find_log_path(
+                guild_id=self.guild_id,
+                channel_id=self.channel_id,
+                guild_name=self.guild_name,
+                channel_name=self.channel_name,
+                ext=self.registry.fmt.ext,
+            )
+        syslog.debug("Opening log %s", self.path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        stream = open(self.path, "ab")
+        if self.index is None:
+            entries = Channel_Manifest(self.channel_id).read()
+            self.index = entries.get(self.path.name) or Segment_Entry()
+        self.index.resync(stream.tell())
+        return stream
+
+    def _save_index(self, entries: dict[str, Segment_Entry] | None = None):
+        try:
+            Channel_Manifest(self.channel_id).update(
+                entries or {self.path.name: self.index}, folder=self.path.parent
+            )
+        except Exception:
+            syslog.exception("Saving manifest of %s", self.path)
+
+    def _roll(self):
+        """Close the active file off as a numbered segment and start a new one"""
+        self._stream.close()
+        segment = next_segment(self.path)
+        self.path.rename(segment)
+        syslog.info("Rolled %s to %s", self.path.name, segment.name)
+        closed, self.index = self.index, Segment_Entry()
+        self._stream = self._open()
+        self._save_index({segment.name: closed, self.path.name: self.index})
+        self.registry.rolled(segment)
+
+    def write(self, records: list[tuple[float, dict]], fsync: bool = False):
+        """Write (created, record) pairs in the archive format, flushing once.
+        Rolls to a new segment first if the write would go over the size limit"""
+        encode = self.registry.fmt.encode
+        chunks = []
+        notes = []
+        for created, record in records:
+            try:
+                chunks.append(encode(created, record))
+            except Exception:
+                syslog.exception("Encoding record %s", record.get("message_id"))
+                continue
+            notes.append((len(chunks[-1]), created, record.get("message_id")))
+
+        with self._lock:
+            if self._stream is None:
+                self._stream = self._open()
+            data = b"".join(chunks)
+            size = self._stream.tell()
+            if size and size + len(data) > self.registry.max_bytes:
+                self._roll()
+            stream = self._stream
+            stream.write(data)
+            stream.flush()
+            if fsync:
+                os.fsync(stream.fileno())
+            self.last_used = time.monotonic()
+            synced = False
+            for length, created, message_id in notes:
+                synced |= self.index.note(length, created, message_id)
+            if synced:
+                # saved as each span starts, so at most one span is ever unsaved
+                self._save_index()
+        self.registry._touch(self)
+
+    def close(self):
+        """Close the file, it will be reopened on the next write"""
+        with self._lock:
+            if self._stream is None:
+                return
+            syslog.debug("Closing log %s", self.path)
+            try:
+                self._stream.close()
+            except Exception:
+                syslog.exception("Closing log %s", self.path)
+            self._stream = None
+            self._save_index()
+
+
+class Log_Registry:
+    """Channel logs keyed by guild/channel ID, with a cap on how many files are open at once.
+    Least recently used logs are closed when over the cap, or after sitting idle"""
+
+    def __init__(
+        self,
+        max_open: int = MAX_OPEN_LOGS,
+        idle_secs: float = LOG_IDLE_SECS,
+        fmt: str = ARCHIVE_FORMAT,
+        max_bytes: int = MESS_SIZE,
+        on_roll: Callable[[Pathy], None] | None = None,
+    ) -> None:
+        self.fmt: Archive_Format = get_format(fmt)
+        self.max_bytes = max_bytes
+        self.on_roll = on_roll
+        self.max_open = max(1, max_open)
+        self.idle_secs = idle_secs
+        self._logs: dict[tuple[int, int], Channel_Log] = {}
+        self._open: OrderedDict[tuple[int, int], Channel_Log] = OrderedDict()
+        self._lock = threading.Lock()
+        self._swept = time.monotonic()
+
+    def __len__(self) -> int:
+        """Number of open log files"""
+        return len(self._open)
+
+    def get(
+        self, guild_id: int, channel_id: int, guild_name: str, channel_name: str
+    ) -> Channel_Log:
+        """Return the log for a channel, the file is only opened when written to"""
+        key = (int(guild_id), int(channel_id))
+        log = self._logs.get(key)
+        if log is None:
+            with self._lock:
+                log = self._logs.get(key)
+                if log is None:
+                    log = Channel_Log(
+                        registry=self,
+                        guild_id=key[0],
+                        channel_id=key[1],
+                        guild_name=guild_name,
+                        channel_name=channel_name,
+                    )
+                    self._logs[key] = log
+        return log
+
+    def _touch(self, log: Channel_Log):
+        """Mark log as most recently used, closing the oldest if over the cap"""
+        key = (log.guild_id, log.channel_id)
+        evict = []
+        with self._lock:
+            self._open[key] = log
+            self._open.move_to_end(key)
+            while len(self._open) > self.max_open:
+                _, old = self._open.popitem(last=False)
+                evict.append(old)
+        for old in evict:
+            old.close()
+
+    def rolled(self, segment: Pathy):
+        """A log was closed off as a segment"""
+        if self.on_roll:
+            try:
+                self.on_roll(segment)
+            except Exception:
+                syslog.exception("on_roll %s", segment)
+
+    def sweep(self):
+        """Close logs that have been idle too long"""
+        now = time.monotonic()
+        if now - self._swept < self.idle_secs / 4:
+            return
+        self._swept = now
+        cutoff = now - self.idle_secs
+        idle = []
+        with self._lock:
+            for key, log in list(self._open.items()):
+                if log.last_used < cutoff:
+                    idle.append(log)
+                    del self._open[key]
+        for log in idle:
+            log.close()
+        if idle:
+            syslog.debug("Closed %s idle logs", len(idle))
+
+    def close_all(self):
+        """Close every open log"""
+        with self._lock:
+            logs = list(self._open.values())
+            self._open.clear()
+        for log in logs:
+            log.close()
+
+
+# MIT APasz
@@ -0,0 +1,253 @@
+"""Zipping a guild's log folder for /get, reusing what was built last time or reading only a window of it"""
+import logging
+import shutil
+import threading
+import zipfile
+from pathlib import Path as Pathy
+
+from .. import SYSLOG, MIRROR_ATTACHMENTS
+from ..util.archive import convert, format_for
+from ..util.file import Paths, Read_Write
+from ..util.render import get_renderer
+from ..util.manifest import Channel_Manifest, Segment_Entry, channel_of
+from ..util.segments import (
+    is_compressed,
+    is_segment,
+    plain_name,
+    read_ranges,
+    zip_locks,
+)
+from ..util.timefmt import Zones
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+STORED = {".gz", ".zst", ".zip"}
+"Already compressed, deflating them again only costs time"
+
+
+def scan(folder: Pathy) -> dict[str, list[int]]:
+    """Every file under folder by relative path, with its size and mtime"""
+    files = {}
+    for file in folder.rglob("*"):
+        if file.is_file():
+            stat = file.stat()
+            files[file.relative_to(folder).as_posix()] = [
+                stat.st_size,
+                stat.st_mtime_ns,
+            ]
+    return files
+
+
+def plain_rel(rel: str) -> str:
+    """Relative path of a log before it was compressed"""
+    path = Pathy(rel)
+    return path.with_name(plain_name(path)).as_posix()
+
+
+class Log_Zip:
+    """Zip of a guild's logs, optionally rendered into fmt.
+    Closed segments never change, so they're kept zipped between requests and only new ones are added.
+    Active logs are added to a copy of that each time.
+    With from_ts/to_ts only the part of each log in the window is zipped, found from the manifests
+    """
+
+    def __init__(
+        self,
+        guild_folder: Pathy,
+        guild_id: int,
+        fmt: str = "RAW",
+        folder: Pathy = Paths.zips,
+        from_ts: float | None = None,
+        to_ts: float | None = None,
+    ) -> None:
+        self.guild_folder = guild_folder
+        self.guild_id = guild_id
+        self.fmt = fmt
+        self.ext = None if fmt == "RAW" else get_renderer(fmt).ext
+        slug = "".join(c if c.isalnum() else "_" for c in fmt)
+        self.base = folder.joinpath(f"{guild_id}_{slug}.zip")
+        self.index = self.base.with_suffix(".json")
+        self.from_ts = from_ts
+        self.to_ts = to_ts
+        self.added = 0
+        "Segments zipped this time round"
+        self.reused = 0
+        "Segments carried over from last time"
+        self.skipped = 0
+        "Logs with nothing in the window"
+
+    def __str__(self) -> str:
+        if self.windowed:
+            return f"added {self.added}, skipped {self.skipped}"
+        return f"added {self.added}, reused {self.reused}"
+
+    @property
+    def windowed(self) -> bool:
+        return self.from_ts is not None or self.to_ts is not None
+
+    def key(self) -> dict:
+        """What else renders depend on, a change means starting over"""
+        if self.fmt == "RAW":
+            return {"fmt": self.fmt}
+        return {
+            "fmt": self.fmt,
+            "zone": Zones.zone_name(self.guild_id),
+            "mirror": MIRROR_ATTACHMENTS,
+        }
+
+    def arcname(self, rel: str) -> str:
+        """Name in the zip, rendered logs take the renderer's extension"""
+        path = Pathy(rel)
+        if not self.ext or not format_for(path):
+            return rel
+        if is_compressed(path):
+            path = path.with_suffix("")
+        return path.with_suffix(self.ext).as_posix()
+
+    def add(self, zf: zipfile.ZipFile, rel: str, src: Pathy | None = None):
+        """Add a log, rendered if it's machine readable and a format was asked for.
+        src= where it's read from, if not the guild folder"""
+        src = src or self.guild_folder.joinpath(rel)
+        arcname = self.arcname(rel)
+        # NDJSON logs keep their name as NDJSON, but still want rendering
+        if self.ext and format_for(Pathy(rel)):
+            tmp = Pathy(zf.filename).with_suffix(".render")
+            try:
+                convert(
+                    src=src,
+                    dst=tmp,
+                    fmt=self.fmt,
+                    from_ts=self.from_ts,
+                    to_ts=self.to_ts,
+                )
+                if tmp.exists():
+                    zf.write(tmp, arcname=arcname, compress_type=zipfile.ZIP_DEFLATED)
+            finally:
+                tmp.unlink(missing_ok=True)
+            return
+        compress = zipfile.ZIP_STORED if src.suffix in STORED else zipfile.ZIP_DEFLATED
+        zf.write(src, arcname=arcname, compress_type=compress)
+
+    def window(
+        self, rel: str, manifests: dict[int, dict[str, Segment_Entry]]
+    ) -> tuple[list[tuple[int, int | None]], Segment_Entry | None] | None:
+        """Byte ranges of a log in the window and its manifest entry, None if nothing is in it"""
+        src = self.guild_folder.joinpath(rel)
+        channel_id = channel_of(src)
+        entry = None
+        if channel_id:
+            if channel_id not in manifests:
+                manifests[channel_id] = Channel_Manifest(channel_id).read()
+            entry = manifests[channel_id].get(plain_name(src))
+        if entry is None:
+            # not indexed, though a segment closed before the window can't be in it
+            if self.from_ts is not None and is_segment(src):
+                if src.stat().st_mtime < self.from_ts:
+                    return None
+            return [(0, None)], None
+        ranges = entry.ranges(self.from_ts, self.to_ts, growing=not is_segment(src))
+        return (ranges, entry) if ranges else None
+
+    def add_ranges(
+        self,
+        zf: zipfile.ZipFile,
+        rel: str,
+        ranges: list[tuple[int, int | None]],
+        entry: Segment_Entry | None,
+    ):
+        """Add part of a log, decompressed"""
+        src = self.guild_folder.joinpath(rel)
+        plain = Pathy(rel).with_name(plain_name(src))
+        tmp = Pathy(zf.filename).with_suffix(".range" + plain.suffix)
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in read_ranges(src, ranges, entry):
+                    f.write(chunk)
+            self.add(zf, plain.as_posix(), src=tmp)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def _build_window(self, dst: Pathy):
+        """Zip only what's in the window, whole logs are only read if they're all in it"""
+        manifests = {}
+        with zipfile.ZipFile(dst, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for rel in sorted(scan(self.guild_folder)):
+                found = self.window(rel, manifests)
+                if found is None:
+                    self.skipped += 1
+                    continue
+                ranges, entry = found
+                if ranges == [(0, None)]:
+                    self.add(zf, rel)
+                else:
+                    self.add_ranges(zf, rel, ranges, entry)
+                self.added += 1
+
+    def _update_base(self, segments: dict[str, list[int]]):
+        """Bring the zip of closed segments up to date, appending where it can"""
+        key = self.key()
+        index = False
+        if self.index.exists() and self.base.exists():
+            index = Read_Write.read_json(file=self.index, cache=False)
+        entries = {}
+        mode = "w"
+        plains = {plain_rel(rel): rel for rel in segments}
+
+        def kept(rel: str, stat: list[int]) -> bool:
+            now = plains.get(plain_rel(rel))
+            if now is None:
+                return False
+            if now == rel:
+                return segments[now] == stat
+            # compressed since it was zipped, which keeps its mtime
+            return segments[now][1] == stat[1]
+
+        if index and index.get("key") == key:
+            entries = index["entries"]
+            # removed or changed segments can't be taken out of a zip
+            if all(kept(rel, stat) for rel, stat in entries.items()):
+                mode = "a"
+            else:
+                entries = {}
+        zipped = {plain_rel(rel) for rel in entries}
+        new = [rel for rel in sorted(segments) if plain_rel(rel) not in zipped]
+        self.reused = len(entries)
+        self.added = len(new)
+        if mode == "a" and not new:
+            return
+
+        self.base.parent.mkdir(exist_ok=True, parents=True)
+        part = self.base.with_name(self.base.name + ".part")
+        if mode == "a":
+            shutil.copyfile(self.base, part)
+        with zipfile.ZipFile(part, mode, compression=zipfile.ZIP_DEFLATED) as zf:
+            for rel in new:
+                self.add(zf, rel)
+                entries[rel] = segments[rel]
+        part.replace(self.base)
+        Read_Write.write_json(data={"key": key, "entries": entries}, file=self.index)
+
+    def build(self, dst: Pathy) -> Pathy:
+        """Zip the guild's logs into dst. Blocking, so run it in a thread"""
+        if self.windowed:
+            dst.parent.mkdir(exist_ok=True, parents=True)
+            self._build_window(dst)
+            syslog.info("Zipped window of logs of %s, %s", self.guild_id, self)
+            return dst
+        files = scan(self.guild_folder)
+        segments = {rel: stat for rel, stat in files.items() if is_segment(Pathy(rel))}
+        dst.parent.mkdir(exist_ok=True, parents=True)
+        with zip_locks.setdefault(self.base, threading.Lock()):
+            self._update_base(segments)
+            shutil.copyfile(self.base, dst)
+        with zipfile.ZipFile(dst, "a", compression=zipfile.ZIP_DEFLATED) as zf:
+            for rel in sorted(files):
+                if rel not in segments:
+                    self.add(zf, rel)
+        syslog.info("Zipped logs of %s, %s", self.guild_id, self)
+        return dst
+
+
+# MIT APasz
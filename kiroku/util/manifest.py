@@ -0,0 +1,164 @@
+"""Index of each channel's log files, so a window of time can be read without reading everything"""
+import logging
+import re
+import threading
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path as Pathy
+
+from .. import SYSLOG, MANIFEST_SYNC_KB
+from ..util.file import Paths, Read_Write
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+CHANNEL_ID = re.compile(r"_\((\d+)\)\.")
+
+SYNC_BYTES = MANIFEST_SYNC_KB * 1024
+
+_locks: dict[int, threading.Lock] = {}
+"One update of each manifest at a time, the writer and segment worker both make them"
+
+
+def channel_of(file: Pathy) -> int | None:
+    """Channel ID of a log file, from its <channel>_(<id>).<ext> name"""
+    if match := CHANNEL_ID.search(file.name):
+        return int(match.group(1))
+    return None
+
+
+@dataclass(slots=True)
+class Segment_Entry:
+    """What's in one log file.
+    Sync points are record boundaries, each starts a span with the first and last time written in it.
+    Spans with no times weren't indexed, such as writes from before the manifest or a crash
+    """
+
+    count: int = 0
+    size: int = 0
+    "Bytes indexed, before compression"
+    first_ts: float | None = None
+    last_ts: float | None = None
+    first_id: int | None = None
+    "Lowest message snowflake"
+    last_id: int | None = None
+    "Highest message snowflake"
+    syncs: list[list] = field(default_factory=list)
+    "[offset, first_ts, last_ts] of each span"
+    members: list[int] | None = None
+    "Where each span starts in the gzip compressed segment, they're separate gzip members"
+
+    def resync(self, size: int):
+        """Mark bytes written without being indexed as a span of unknown times"""
+        if size == self.size:
+            return
+        if size < self.size:
+            # truncated or replaced, nothing known holds
+            self.count = 0
+            self.first_ts = self.last_ts = self.first_id = self.last_id = None
+            self.syncs = [[0, None, None]] if size else []
+        else:
+            self.syncs.append([self.size, None, None])
+        self.size = size
+        self.members = None
+
+    def note(self, length: int, ts: float, message_id: int | None) -> bool:
+        """Index a record written at the end of the file. True if it started a new span"""
+        offset = self.size
+        self.size += length
+        self.count += 1
+        if self.first_ts is None:
+            self.first_ts = ts
+        self.last_ts = ts if self.last_ts is None else max(self.last_ts, ts)
+        if message_id:
+            self.first_id = min(self.first_id or message_id, message_id)
+            self.last_id = max(self.last_id or message_id, message_id)
+
+        last = self.syncs[-1] if self.syncs else None
+        if last is None or last[1] is None or offset - last[0] >= SYNC_BYTES:
+            self.syncs.append([offset, ts, ts])
+            return True
+        last[1] = min(last[1], ts)
+        last[2] = max(last[2], ts)
+        return False
+
+    def ranges(
+        self, from_ts: float | None, to_ts: float | None, growing: bool = False
+    ) -> list[tuple[int, int | None]]:
+        """Byte ranges holding records written from from_ts up to to_ts, None ending at end of file.
+        Ranges are whole spans, so may hold a little either side of the window.
+        growing= an active log, its last span may have more in it than was saved"""
+        ranges = []
+        for number, (start, first, last) in enumerate(self.syncs):
+            end = self.syncs[number + 1][0] if number + 1 < len(self.syncs) else None
+            if end is None and growing:
+                last = None
+            if first is not None:
+                if to_ts is not None and first >= to_ts:
+                    continue
+                if from_ts is not None and last is not None and last < from_ts:
+                    continue
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def member(self, offset: int) -> int | None:
+        """Where the span starting at offset starts in the compressed segment"""
+        if self.members is None:
+            return None
+        for (start, _, _), member in zip(self.syncs, self.members):
+            if start == offset:
+                return member
+        return None
+
+
+class Channel_Manifest:
+    """Entries of a channel's log files by name, kept in data/manifests/<channel_id>.json.
+    Compressed segments go by the name they had before compression"""
+
+    def __init__(self, channel_id: int, folder: Pathy = Paths.manifests) -> None:
+        self.channel_id = channel_id
+        self.path = folder.joinpath(f"{channel_id}.json")
+
+    def read(self) -> dict[str, Segment_Entry]:
+        if not self.path.exists():
+            return {}
+        data = Read_Write.read_json(file=self.path, cache=False)
+        if not data:
+            return {}
+        names = {f.name for f in fields(Segment_Entry)}
+        entries = {}
+        for name, entry in data.get("entries", {}).items():
+            try:
+                entries[name] = Segment_Entry(
+                    **{k: v for k, v in entry.items() if k in names}
+                )
+            except TypeError:
+                syslog.exception("Manifest %s entry %s", self.path.name, name)
+        return entries
+
+    def update(self, entries: dict[str, Segment_Entry], folder: Pathy | None = None):
+        """Save entries over what's there. With folder, entries of files no longer in it are dropped"""
+        with _locks.setdefault(self.channel_id, threading.Lock()):
+            saved = self.read()
+            saved.update(entries)
+            if folder is not None:
+                present = set()
+                for file in folder.glob(f"*_({self.channel_id}).*"):
+                    # compressed segments go by their plain name too
+                    present.update((file.name, file.with_suffix("").name))
+                saved = {
+                    name: entry for name, entry in saved.items() if name in present
+                }
+            Read_Write.write_json(
+                data={
+                    "channel_id": self.channel_id,
+                    "entries": {name: asdict(entry) for name, entry in saved.items()},
+                },
+                file=self.path,
+            )
+
+
+# MIT APasz
@@ -0,0 +1,117 @@
+"""Resolving message authors to guild members"""
+import asyncio
+import logging
+from collections.abc import Iterable
+
+import hikari
+
+from .. import SYSLOG, MEMBER_FETCH_CONCURRENCY
+from ..util.budget import Rate_Budget
+from ..util.metrics import (
+    MEMBER_FAILURES,
+    MEMBER_FETCHES,
+    MEMBER_MISSING,
+    MEMBER_SECONDS,
+)
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+
+class Member_Resolver:
+    """Member lookups for one run over a guild.
+    Found and missing members are both remembered, lookups for the same user share one fetch,
+    and fetches run a few at a time"""
+
+    def __init__(
+        self,
+        app: hikari.RESTAware,
+        guild: hikari.Guild,
+        concurrency: int = MEMBER_FETCH_CONCURRENCY,
+        budget: Rate_Budget | None = None,
+    ) -> None:
+        """budget= shared with whatever else is making requests alongside"""
+        self.app = app
+        self.guild = guild
+        self.budget = budget
+        self._known: dict[int, hikari.Member | None] = {}
+        self._pending: dict[int, asyncio.Future] = {}
+        self._limit = asyncio.Semaphore(concurrency)
+        self.hits = 0
+        "Answered from memory, the gateway cache or the message itself"
+        self.misses = 0
+        "Had to be fetched"
+        self.missing = 0
+        "Fetched and not in the guild"
+        self.errors = 0
+
+    def __str__(self) -> str:
+        return f"members {len(self._known)}, hits {self.hits}, misses {self.misses}, missing {self.missing}, errors {self.errors}"
+
+    def _cached(self, message: hikari.Message) -> tuple[bool, hikari.Member | None]:
+        """Member without awaiting, if known"""
+        user_id = int(message.author.id)
+        if user_id in self._known:
+            return True, self._known[user_id]
+        mem = message.member or self.guild.get_member(user_id)
+        if mem:
+            self._known[user_id] = mem
+            return True, mem
+        return False, None
+
+    async def resolve(self, message: hikari.Message) -> hikari.Member | None:
+        """Member object for a message's author, None if they aren't in the guild"""
+        found, mem = self._cached(message)
+        if found:
+            self.hits += 1
+            return mem
+
+        user_id = int(message.author.id)
+        future = self._pending.get(user_id)
+        if future is None:
+            self.misses += 1
+            future = asyncio.ensure_future(self._fetch(user_id))
+            self._pending[user_id] = future
+        else:
+            self.hits += 1
+        return await asyncio.shield(future)
+
+    async def _fetch(self, user_id: int) -> hikari.Member | None:
+        try:
+            async with self._limit:
+                if self.budget:
+                    await self.budget.take()
+                MEMBER_FETCHES.inc()
+                with MEMBER_SECONDS.time():
+                    mem = await self.app.rest.fetch_member(
+                        guild=self.guild, user=user_id
+                    )
+        except hikari.NotFoundError:
+            syslog.debug("Unknown Member: %s", user_id)
+            self.missing += 1
+            MEMBER_MISSING.inc()
+            mem = None
+        except Exception:
+            # not remembered, a later message can try again
+            syslog.exception("Fetch Member")
+            self.errors += 1
+            MEMBER_FAILURES.inc()
+            return None
+        finally:
+            self._pending.pop(user_id, None)
+        self._known[user_id] = mem
+        return mem
+
+    async def prefetch(self, messages: Iterable[hikari.Message]):
+        """Look up every unknown author in a batch of messages at once"""
+        unknown = {}
+        for message in messages:
+            found, _ = self._cached(message)
+            if not found:
+                unknown.setdefault(int(message.author.id), message)
+        if unknown:
+            await asyncio.gather(*(self.resolve(msg) for msg in unknown.values()))
+
+
+# MIT APasz
@@ -0,0 +1,288 @@
+"""Counters, latency histograms and gauges, exported in the Prometheus text format"""
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path as Pathy
+
+from aiohttp import web
+
+from .. import SYSLOG, METRICS_HOST, METRICS_PORT, METRICS_SECS
+from ..util.file import Paths, Read_Write
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+PREFIX = "kiroku_"
+
+LATENCY = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"In seconds, default histogram buckets"
+
+
+class Counter:
+    """Only goes up, safe to bump from any thread"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> list[tuple[str, float]]:
+        return [(self.name, self.value)]
+
+
+class Histogram:
+    """Observations counted into buckets, each bucket counting everything up to its bound"""
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, buckets: tuple[float, ...] = LATENCY
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        "Per bucket, not cumulative, the last is over every bound"
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> "Timer":
+        """Observe how long a with block takes"""
+        return Timer(self)
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket the q quantile falls in"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self) -> list[tuple[str, float]]:
+        samples = []
+        seen = 0
+        with self._lock:
+            for bound, count in zip(self.buckets, self.counts):
+                seen += count
+                samples.append((f'{self.name}_bucket{{le="{bound}"}}', seen))
+            samples.append((f'{self.name}_bucket{{le="+Inf"}}', self.count))
+            samples.append((f"{self.name}_sum", self.sum))
+            samples.append((f"{self.name}_count", self.count))
+        return samples
+
+
+class Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self) -> "Timer":
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.start)
+
+
+class Gauge:
+    """Read when exported, from func.
+    kind="counter" for totals something else already keeps"""
+
+    def __init__(
+        self, name: str, help: str, func: Callable[[], float], kind: str = "gauge"
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+
+    def samples(self) -> list[tuple[str, float]]:
+        try:
+            return [(self.name, self.func())]
+        except Exception:
+            # what it reads may not be set up yet
+            return []
+
+
+class Metrics:
+    """Every metric by name, names are given the kiroku_ prefix"""
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Counter | Histogram | Gauge] = {}
+        self.started = time.time()
+        self._last: tuple[float, dict[str, float]] = (time.monotonic(), {})
+        "When summary was last called and the counters then, for rates"
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(PREFIX + name, help))
+
+    def histogram(
+        self, name: str, help: str, buckets: tuple[float, ...] = LATENCY
+    ) -> Histogram:
+        return self._add(Histogram(PREFIX + name, help, buckets))
+
+    def gauge(
+        self, name: str, help: str, func: Callable[[], float], kind: str = "gauge"
+    ) -> Gauge:
+        """Replaces a gauge of the same name, so reloading what registers it is fine"""
+        self._metrics.pop(PREFIX + name, None)
+        return self._add(Gauge(PREFIX + name, help, func, kind))
+
+    def render(self) -> str:
+        """Prometheus text format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Human readable, counters with their rate since the last summary"""
+        now = time.monotonic()
+        then, before = self._last
+        elapsed = max(now - then, 1e-9)
+        totals = {}
+        lines = [f"Up {time.time() - self.started:.0f}s, rates over {elapsed:.0f}s"]
+        for metric in self._metrics.values():
+            name = metric.name.removeprefix(PREFIX)
+            if isinstance(metric, Histogram):
+                if not metric.count:
+                    lines.append(f"{name}: none")
+                    continue
+                lines.append(
+                    f"{name}: {metric.count} mean {metric.sum / metric.count:.4f} "
+                    f"p50 <{metric.quantile(0.5)} p95 <{metric.quantile(0.95)} p99 <{metric.quantile(0.99)}"
+                )
+                continue
+            samples = metric.samples()
+            if not samples:
+                continue
+            value = samples[0][1]
+            if metric.kind == "counter":
+                totals[metric.name] = value
+                rate = (value - before.get(metric.name, 0)) / elapsed
+                lines.append(f"{name}: {value} ({rate:.2f}/s)")
+            else:
+                lines.append(f"{name}: {value}")
+        self._last = (now, totals)
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+EVENT_TO_DISK = metrics.histogram(
+    "event_to_disk_seconds", "Message event handled to its record written to disk"
+)
+RETRIEVED = metrics.counter(
+    "retrieved_messages_total", "Messages written by retrieve jobs and guild archives"
+)
+REST_PAGES = metrics.counter(
+    "history_pages_total", "Pages of channel history fetched over REST"
+)
+REST_PAGE_SECONDS = metrics.histogram(
+    "history_page_seconds", "Waiting on a page of channel history"
+)
+MEMBER_FETCHES = metrics.counter("member_fetches_total", "fetch_member calls")
+MEMBER_FAILURES = metrics.counter(
+    "member_fetch_failures_total", "fetch_member calls that errored"
+)
+MEMBER_MISSING = metrics.counter(
+    "member_fetch_missing_total", "fetch_member calls for users not in the guild"
+)
+MEMBER_SECONDS = metrics.histogram("member_fetch_seconds", "fetch_member latency")
+
+
+class Metrics_Exporter:
+    """Writes the metrics to a file every so often, and serves them over HTTP if given a port.
+    The file suits node_exporter's textfile collector, the endpoint a local scraper"""
+
+    def __init__(
+        self,
+        registry: Metrics = metrics,
+        file: Pathy = Paths.file_metrics,
+        secs: float = METRICS_SECS,
+        host: str = METRICS_HOST,
+        port: int = METRICS_PORT,
+    ) -> None:
+        self.registry = registry
+        self.file = file
+        self.secs = secs
+        self.host = host
+        self.port = port
+        self._task: asyncio.Task | None = None
+        self._runner: web.AppRunner | None = None
+
+    async def start(self):
+        if self.secs > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run(), name="metrics_file")
+        if self.port and self._runner is None:
+            app = web.Application()
+            app.router.add_get("/metrics", self._serve)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, self.host, self.port).start()
+            syslog.info("Serving metrics on %s:%s", self.host, self.port)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            await self.write()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def write(self):
+        text = self.registry.render()
+        await Read_Write.write_bytes_async(
+            data=text.encode("utf-8"), file=self.file, ext=self.file.suffix
+        )
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.secs)
+            try:
+                await self.write()
+            except Exception:
+                syslog.exception("Writing metrics")
+
+    async def _serve(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=self.registry.render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+
+# MIT APasz
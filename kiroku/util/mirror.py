@@ -0,0 +1,224 @@
+"""Keeping local copies of attachments, so archives outlive their expiring links"""
+import asyncio
+import hashlib
+import logging
+import os
+from collections.abc import Iterable
+from pathlib import Path as Pathy
+
+import aiohttp
+
+from .. import (
+    SYSLOG,
+    MIRROR_ATTACHMENTS,
+    MIRROR_BANDWIDTH_KBPS,
+    MIRROR_CONCURRENCY,
+    MIRROR_MAX_MB,
+)
+from ..store import Store
+from ..util.budget import Rate_Budget
+from ..util.file import Paths
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+CHUNK = 64 * 1024
+
+
+def blob_name(sha256: str, filename: str) -> str:
+    """Blobs are named by content, fanned out by the first two hex digits.
+    The suffix is kept so they open with the right program"""
+    suffix = Pathy(filename).suffix.lower()
+    if not suffix[1:].isalnum() or len(suffix) > 10:
+        suffix = ""
+    return f"{sha256[:2]}/{sha256}{suffix}"
+
+
+def rewrite(records: Iterable[dict]):
+    """Point attachments that have been mirrored at their blob, for records read back from disk"""
+    attachments = [
+        attach
+        for record in records
+        for attach in record.get("attachments", ())
+        if "blob" not in attach
+    ]
+    if not attachments:
+        return
+    found = Store.database.blobs(attach["id"] for attach in attachments)
+    for attach in attachments:
+        if blob := found.get(attach["id"]):
+            attach["blob"] = blob
+
+
+class Attachment_Mirror:
+    """Downloads attachments into content addressed blobs, the same file reposted is kept once.
+    Downloads share one connection pool, run a few at a time and can be held to a bandwidth
+    """
+
+    def __init__(
+        self,
+        folder: Pathy = Paths.blobs,
+        concurrency: int = MIRROR_CONCURRENCY,
+        bandwidth_kbps: float = MIRROR_BANDWIDTH_KBPS,
+        max_mb: float = MIRROR_MAX_MB,
+    ) -> None:
+        self.folder = folder
+        self.concurrency = concurrency
+        self.max_size = int(max_mb * 1024 * 1024)
+        self.budget = None
+        if bandwidth_kbps > 0:
+            rate = bandwidth_kbps * 1024
+            self.budget = Rate_Budget(rate=rate, burst=int(max(rate, CHUNK)))
+        self._session: aiohttp.ClientSession | None = None
+        self._limit = asyncio.Semaphore(concurrency)
+        self._pending: dict[int, asyncio.Future] = {}
+        self._background: set[asyncio.Task] = set()
+        self.fetched = 0
+        self.deduped = 0
+        "Downloaded but already held"
+        self.skipped = 0
+        "Too big"
+        self.errors = 0
+        self.bytes = 0
+
+    def __str__(self) -> str:
+        return f"fetched {self.fetched}, deduped {self.deduped}, skipped {self.skipped}, errors {self.errors}, bytes {self.bytes}"
+
+    @property
+    def live(self) -> bool:
+        """Whether messages are mirrored as they're logged"""
+        return MIRROR_ATTACHMENTS == "ALL"
+
+    @property
+    def retrieve(self) -> bool:
+        """Whether retrieved messages are mirrored"""
+        return MIRROR_ATTACHMENTS in ("RETRIEVE", "ALL")
+
+    @property
+    def pending(self) -> int:
+        """Downloads in flight"""
+        return len(self._pending)
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=60),
+            )
+        return self._session
+
+    async def close(self):
+        """Wait out background downloads and close the pool"""
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def mirror(self, records: Iterable[dict]):
+        """Mirror the attachments of records and point them at their blobs"""
+        attachments = [
+            attach for record in records for attach in record.get("attachments", ())
+        ]
+        if not attachments:
+            return
+        found = await asyncio.to_thread(
+            Store.database.blobs, (attach["id"] for attach in attachments)
+        )
+        missing = {
+            attach["id"]: attach for attach in attachments if attach["id"] not in found
+        }
+        if missing:
+            blobs = await asyncio.gather(*(self.fetch(a) for a in missing.values()))
+            found.update(
+                (attach_id, blob)
+                for attach_id, blob in zip(missing, blobs)
+                if blob is not None
+            )
+        for attach in attachments:
+            if blob := found.get(attach["id"]):
+                attach["blob"] = blob
+
+    def submit(self, records: Iterable[dict]):
+        """Mirror in the background, the records themselves are left alone"""
+        attachments = [
+            dict(attach)
+            for record in records
+            for attach in record.get("attachments", ())
+        ]
+        if not attachments:
+            return
+        task = asyncio.create_task(self.mirror([{"attachments": attachments}]))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def fetch(self, attach: dict) -> str | None:
+        """Blob for an attachment, lookups of the same attachment share one download"""
+        attach_id = attach["id"]
+        future = self._pending.get(attach_id)
+        if future is None:
+            future = asyncio.ensure_future(self._download(attach))
+            self._pending[attach_id] = future
+            future.add_done_callback(lambda _: self._pending.pop(attach_id, None))
+        return await asyncio.shield(future)
+
+    async def _download(self, attach: dict) -> str | None:
+        if attach.get("size", 0) > self.max_size:
+            self.skipped += 1
+            return None
+        self.folder.mkdir(exist_ok=True, parents=True)
+        part = self.folder.joinpath(f"{attach['id']}.part")
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            async with self._limit:
+                async with self.session().get(attach["url"]) as resp:
+                    resp.raise_for_status()
+                    with open(part, "wb") as f:
+                        async for chunk in resp.content.iter_chunked(CHUNK):
+                            if self.budget:
+                                await self.budget.take(len(chunk))
+                            size += len(chunk)
+                            if size > self.max_size:
+                                self.skipped += 1
+                                return None
+                            sha.update(chunk)
+                            f.write(chunk)
+            digest = sha.hexdigest()
+            blob = await asyncio.to_thread(
+                self._store, part, digest, attach["filename"]
+            )
+            await asyncio.to_thread(
+                Store.database.add_blob, attach["id"], digest, blob, size
+            )
+        except aiohttp.ClientResponseError as e:
+            # gone or expired, nothing to keep
+            syslog.warning("Mirror attachment %s: %s", attach["id"], e.status)
+            self.errors += 1
+            return None
+        except Exception:
+            # not remembered, a later pass can try again
+            syslog.exception("Mirror attachment %s", attach["id"])
+            self.errors += 1
+            return None
+        finally:
+            part.unlink(missing_ok=True)
+        self.fetched += 1
+        self.bytes += size
+        return blob
+
+    def _store(self, part: Pathy, digest: str, filename: str) -> str:
+        """Move a download into place, unless the content is already held"""
+        if blob := Store.database.blob_for(digest):
+            if self.folder.joinpath(blob).exists():
+                self.deduped += 1
+                return blob
+        blob = blob_name(digest, filename)
+        dest = self.folder.joinpath(blob)
+        dest.parent.mkdir(exist_ok=True)
+        os.replace(part, dest)
+        return blob
+
+
+# MIT APasz
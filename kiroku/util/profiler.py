@@ -0,0 +1,221 @@
+"""Owner started profiling of chosen listeners and commands, and memory snapshot diffs"""
+import cProfile
+import functools
+import io
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+import zipfile
+from collections.abc import Awaitable, Callable, Coroutine
+from pathlib import Path as Pathy
+
+from .. import SYSLOG, PROFILE_TOP
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+TARGETS = ("mesc", "mesu", "retrieve", "get")
+"What can be profiled, each has @profiled with its name, and work it hands to threads profiler.call"
+
+
+def _enable(profile: cProfile.Profile) -> bool:
+    """False if another profiler has the interpreter, as one on another thread can from 3.12"""
+    try:
+        profile.enable()
+    except ValueError:
+        return False
+    return True
+
+
+class Profiled:
+    """Awaits coro with a profiler enabled only while coro itself is running.
+    Whatever else the loop runs between its steps isn't counted, nor is work it hands to threads
+    """
+
+    __slots__ = ("coro", "profile")
+
+    def __init__(self, coro: Coroutine, profile: cProfile.Profile) -> None:
+        self.coro = coro
+        self.profile = profile
+
+    def __await__(self):
+        coro = self.coro
+        send, error = None, None
+        while True:
+            stepping = not Profile_Session.stepping
+            if stepping:
+                # a profiled coroutine awaiting another is already being profiled
+                stepping = _enable(self.profile)
+                Profile_Session.stepping = stepping
+            try:
+                if error is not None:
+                    step = coro.throw(error)
+                else:
+                    step = coro.send(send)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                if stepping:
+                    self.profile.disable()
+                    Profile_Session.stepping = False
+            try:
+                send, error = (yield step), None
+            except BaseException as exc:
+                send, error = None, exc
+
+
+class Profile_Session:
+    """A cProfile profile per target, from start until stop.
+    Work run in threads is profiled separately and merged into its target's report"""
+
+    stepping = False
+    "A profiler is enabled on the event loop, only one can be at a time"
+
+    def __init__(self) -> None:
+        self.profiles: dict[str, cProfile.Profile] = {}
+        self.threaded: dict[str, list[cProfile.Profile]] = {}
+        self.calls: dict[str, int] = {}
+        self.started: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self.started is not None
+
+    def start(self, targets: list[str]):
+        self.profiles = {target: cProfile.Profile() for target in targets}
+        self.threaded = {target: [] for target in targets}
+        self.calls = dict.fromkeys(targets, 0)
+        self.started = time.monotonic()
+        syslog.warning("Profiling %s", ", ".join(targets))
+
+    def wrap(self, target: str, coro: Coroutine) -> Awaitable:
+        profile = self.profiles.get(target)
+        if profile is None:
+            return coro
+        self.calls[target] += 1
+        return Profiled(coro, profile)
+
+    def call(self, target: str, func: Callable, *args):
+        """func(*args) with a profiler of its own, for work a target runs in a thread"""
+        threaded = self.threaded.get(target)
+        if threaded is None:
+            return func(*args)
+        profile = cProfile.Profile()
+        if not _enable(profile):
+            return func(*args)
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            with self._lock:
+                threaded.append(profile)
+
+    def stop(self, file: Pathy, top: int = PROFILE_TOP) -> Pathy:
+        """End the session, writing a zip of a pstats report and each target's .prof to file"""
+        elapsed = time.monotonic() - self.started
+        profiles, self.profiles, self.started = self.profiles, {}, None
+        with self._lock:
+            threaded, self.threaded = self.threaded, {}
+        syslog.warning("Profiling stopped after %.0fs", elapsed)
+
+        report = io.StringIO()
+        report.write(f"Profiled for {elapsed:.0f}s\n")
+        with zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for target, profile in profiles.items():
+                report.write(f"\n{'=' * 20} {target}: {self.calls[target]} calls\n")
+                ran = []
+                for each in (profile, *threaded[target]):
+                    each.create_stats()
+                    if each.stats:
+                        ran.append(each)
+                if not ran:
+                    continue
+                stats = pstats.Stats(*ran, stream=report)
+                stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+                stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+                # load with pstats, snakeviz and the like
+                dump = file.with_name(f"{file.stem}_{target}.prof")
+                stats.dump_stats(dump)
+                zf.write(dump, arcname=f"{target}.prof")
+                dump.unlink()
+            zf.writestr("report.txt", report.getvalue())
+        return file
+
+
+profiler = Profile_Session()
+
+
+def profiled(target: str):
+    """Profile the decorated coroutine function under target, while a session includes it"""
+
+    def decorate(func: Callable[..., Coroutine]):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if target not in profiler.profiles:
+                return await func(*args, **kwargs)
+            return await profiler.wrap(target, func(*args, **kwargs))
+
+        return wrapper
+
+    return decorate
+
+
+class Memory_Diff:
+    """tracemalloc from start, stop compares where memory is allocated now against then"""
+
+    def __init__(self) -> None:
+        self.baseline: tracemalloc.Snapshot | None = None
+        self.started: float | None = None
+
+    @property
+    def active(self) -> bool:
+        return self.baseline is not None
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            )
+        )
+
+    def start(self, frames: int = 1):
+        """Tracing slows every allocation, stop it once done"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.baseline = self._snapshot()
+        self.started = time.monotonic()
+        syslog.warning("Tracing allocations")
+
+    def stop(self, file: Pathy, top: int = PROFILE_TOP) -> Pathy:
+        """Stop tracing, writing the largest growth in allocations by line to file"""
+        snapshot = self._snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        elapsed = time.monotonic() - self.started
+        baseline, self.baseline, self.started = self.baseline, None, None
+        syslog.warning("Allocation tracing stopped after %.0fs", elapsed)
+
+        lines = [
+            f"Traced for {elapsed:.0f}s, {current / 1024:.1f} KiB traced now, {peak / 1024:.1f} KiB peak",
+            "",
+            f"Top {top} by growth",
+        ]
+        stats = snapshot.compare_to(baseline, "lineno")
+        lines.extend(str(stat) for stat in stats[:top])
+        lines.extend(("", f"Top {top} by size"))
+        lines.extend(str(stat) for stat in snapshot.statistics("lineno")[:top])
+        file.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        return file
+
+
+memory = Memory_Diff()
+
+
+# MIT APasz
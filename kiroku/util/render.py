@@ -0,0 +1,332 @@
+"""Output formats records are rendered into.
+Each format is compiled once into a render function and registered by name"""
+import logging
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+
+from .. import SYSLOG
+from ..util import serial
+from ..util.file import bytes_to_human
+from ..util.timefmt import Time_Format, Zones
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+LINK = "https://discord.com/channels/{}/{}/{}".format
+USER_LINE = "User: {} | Global: {} | Nick: {} | ID: {}".format
+ATTACH_LINES = "\n".join(
+    (
+        "\tID: {} | Type: {}",
+        "\tSize: {} | {}Bytes",
+        "\tFilename: {}",
+        "\tURL: {}",
+        "\tURL Expiry: {} | {}",
+    )
+).format
+EMBED_LINES = (
+    ("title", "\tTitle: "),
+    ("url", "\tURL: "),
+    ("author", "\tAuthor: "),
+    ("author_url", "\tAuthor URL: "),
+    ("provider", "\tProvider: "),
+)
+"Embed fields in the order shown, author_url is only kept alongside author"
+MARKS = ("  ", "A ", " E", "AE")
+"Compact attachment/embed column, indexed by has_attachments | has_embeds << 1"
+
+Render = Callable[[dict, Time_Format | None], Any]
+
+
+def find_link_expiry(link: str) -> int:
+    times = link.rsplit("ex=")[-1]
+    ex = times.split("&")[0]
+    exp = int(float.fromhex(ex))
+    return exp
+
+
+def message_link(record: dict) -> str:
+    """Jump link for a record"""
+    return LINK(record["guild_id"], record["channel_id"], record["message_id"])
+
+
+def snowflake_ts(snowflake: int) -> float:
+    """Creation time of a snowflake"""
+    return round(((int(snowflake) >> 22) + 1_420_070_400_000) / 1000, 3)
+
+
+def ts_snowflake(ts: float) -> int:
+    """Lowest snowflake created at ts, for seeking history to a time"""
+    return max(0, int(ts * 1000) - 1_420_070_400_000) << 22
+
+
+def record_key(record: dict) -> str:
+    """Key of a record in JSON output, edits sit alongside the message they change"""
+    if record.get("edit"):
+        return f"{record['message_id']}@{record.get('edited_at_ts', '')}"
+    return str(record["message_id"])
+
+
+def record_ts(record: dict) -> float:
+    """When a record happened, edits by their edit"""
+    if record.get("edit") and record.get("edited_at_ts"):
+        return record["edited_at_ts"]
+    return record.get("created_at_ts") or snowflake_ts(record["message_id"])
+
+
+def record_times(record: dict) -> list[float]:
+    """Every timestamp a record's render shows"""
+    times = []
+    if "created_at_ts" in record:
+        times.append(record["created_at_ts"])
+    if edited_at := record.get("edited_at_ts"):
+        times.append(edited_at)
+    for attach in record.get("attachments", ()):
+        times.append(find_link_expiry(attach["url"]))
+    return times
+
+
+def attach_dict(attach: dict, tf: Time_Format) -> dict:
+    exp = find_link_expiry(attach["url"])
+    data = {
+        "id": attach["id"],
+        "media_type": attach["media_type"],
+        "size": attach["size"],
+        "size_nice": bytes_to_human(attach["size"]),
+        "filename": attach["filename"],
+        "url": attach["url"],
+        "url_expiry": exp,
+        "url_expiry_local": tf.format(exp),
+    }
+    if "blob" in attach:
+        data["blob"] = attach["blob"]
+    return data
+
+
+def attach_str(attach: dict, tf: Time_Format) -> str:
+    exp = find_link_expiry(attach["url"])
+    size = attach["size"]
+    text = ATTACH_LINES(
+        attach["id"],
+        attach["media_type"],
+        bytes_to_human(size),
+        size,
+        attach["filename"],
+        attach["url"],
+        tf.format(exp),
+        exp,
+    )
+    if "blob" in attach:
+        text += f"\n\tBlob: {attach['blob']}"
+    return text
+
+
+def embed_str(embed: dict) -> str:
+    return "\n".join(
+        label + str(embed[key]) for key, label in EMBED_LINES if key in embed
+    )
+
+
+def compile_json() -> Render:
+    """Nice JSON, a dict per record"""
+
+    def edit(record: dict, tf: Time_Format) -> dict:
+        data = {
+            "edit_of": record["message_id"],
+            "message_link": message_link(record),
+        }
+        if edited_at := record.get("edited_at_ts"):
+            data["edited_at_ts"] = edited_at
+            data["edited_at_local"] = tf.format(edited_at)
+        if "content" in record:
+            data["content"] = record["content"]
+        if "attachments" in record:
+            attachments = record["attachments"]
+            data["attachment_count"] = len(attachments)
+            data["attachments"] = [attach_dict(attach, tf) for attach in attachments]
+        if "embeds" in record:
+            data["embed_count"] = len(record["embeds"])
+            data["embeds"] = list(record["embeds"])
+        return data
+
+    def render(record: dict, tf: Time_Format | None = None) -> dict:
+        tf = tf or Zones.get(record["guild_id"])
+        if record.get("edit"):
+            return edit(record, tf)
+
+        author = record["author"]
+        created_at = record["created_at_ts"]
+        data = {
+            "author": {
+                "id": author["id"],
+                "user": author["user"],
+                "global": author["global"],
+                "nick": author["nick"],
+                "is_bot": author["is_bot"],
+                "is_system": author["is_system"],
+            },
+            "content": record["content"],
+            "message_id": record["message_id"],
+            "message_link": message_link(record),
+            "created_at_ts": created_at,
+            "created_at_local": tf.format(created_at),
+        }
+        if edited_at := record.get("edited_at_ts"):
+            data["edited_at_ts"] = edited_at
+            data["edited_at_local"] = tf.format(edited_at)
+        if attachments := record.get("attachments"):
+            data["attachment_count"] = len(attachments)
+            data["attachments"] = [attach_dict(attach, tf) for attach in attachments]
+        if embeds := record.get("embeds"):
+            data["embed_count"] = len(embeds)
+            data["embeds"] = list(embeds)
+        return data
+
+    return render
+
+
+def compile_txt() -> Render:
+    """Nice multi-line text per record"""
+
+    def edit(record: dict, tf: Time_Format) -> str:
+        text = [
+            f"Edit of Message ID: {record['message_id']}",
+            f"Message Link: {message_link(record)}",
+        ]
+        if edited_at := record.get("edited_at_ts"):
+            text.append(f"Edited at: {tf.format(edited_at)} | {edited_at}")
+        if "content" in record:
+            text.append(f"Content: {record['content']}")
+        if "attachments" in record:
+            attachments = record["attachments"]
+            text.append(f"Attachments  {len(attachments)}")
+            text.extend(attach_str(attach, tf) for attach in attachments)
+        if "embeds" in record:
+            embeds = record["embeds"]
+            text.append(f"Embeds  {len(embeds)}")
+            text.extend(embed_str(embed) for embed in embeds)
+        text.append("\n")
+        return "\n".join(text)
+
+    def render(record: dict, tf: Time_Format | None = None) -> str:
+        tf = tf or Zones.get(record["guild_id"])
+        if record.get("edit"):
+            return edit(record, tf)
+
+        author = record["author"]
+        edited_at = record.get("edited_at_ts")
+        created_at = record["created_at_ts"]
+
+        userline = USER_LINE(
+            author["user"], author["global"], author["nick"], author["id"]
+        )
+        if author["is_bot"]:
+            userline += " | IS_BOT"
+        if author["is_system"]:
+            userline += " | IS_SYSTEM"
+
+        text = [
+            userline,
+            f"Content: {record['content']}",
+            f"Message ID: {record['message_id']}" + (" (Edited)" if edited_at else ""),
+            f"Message Link: {message_link(record)}",
+            f"Created at: {tf.format(created_at)} | {created_at}",
+        ]
+        if edited_at:
+            text.append(f"Edited at: {tf.format(edited_at)} | {edited_at}")
+
+        if attachments := record.get("attachments"):
+            count = f"Attachments  {len(attachments)}"
+            for attach in attachments:
+                text.append(count)
+                text.append(attach_str(attach, tf))
+        if embeds := record.get("embeds"):
+            count = f"Embeds  {len(embeds)}"
+            for embed in embeds:
+                text.append(count)
+                text.append(embed_str(embed))
+
+        text.append("\n")
+        return "\n".join(text)
+
+    return render
+
+
+def compile_compact(width: int = 36) -> Render:
+    """One line per record, author padded to width"""
+    line = ("{:%d}|{}|{}| {}" % width).format
+
+    def render(record: dict, tf: Time_Format | None = None) -> str:
+        tf = tf or Zones.get(record["guild_id"])
+        marks = MARKS[bool(record.get("attachments")) | bool(record.get("embeds")) << 1]
+        if record.get("edit"):
+            edited_at = record.get("edited_at_ts") or snowflake_ts(record["message_id"])
+            return line(
+                f"EDIT {record['message_id']}",
+                tf.format(edited_at),
+                marks,
+                record.get("content", ""),
+            )
+        return line(
+            record["author"]["display"],
+            tf.format(record["created_at_ts"]),
+            marks,
+            record["content"],
+        )
+
+    return render
+
+
+def compile_ndjson(json: Render) -> Render:
+    """A compact JSON line per record"""
+    dumps = serial.dumps
+
+    def render(record: dict, tf: Time_Format | None = None) -> bytes:
+        return dumps(json(record, tf))
+
+    return render
+
+
+@dataclass(frozen=True, slots=True)
+class Renderer:
+    """A registered output format"""
+
+    name: str
+    ext: str
+    layout: str
+    "TEXT | LINES | OBJECT; str per record joined by newlines, bytes per line, or dict keyed by record"
+    render: Render
+
+
+RENDERERS: dict[str, Renderer] = {}
+
+
+def register(name: str, ext: str, layout: str, render: Render) -> Renderer:
+    """Add an output format, replacing any of the same name"""
+    renderer = Renderer(name=name.upper(), ext=ext, layout=layout, render=render)
+    RENDERERS[renderer.name] = renderer
+    return renderer
+
+
+def get_renderer(name: str) -> Renderer:
+    renderer = RENDERERS.get(name.upper())
+    if renderer is None:
+        raise ValueError(f"Unknown format: {name}")
+    return renderer
+
+
+render_json = register("JSON", ".json", "OBJECT", compile_json()).render
+render_txt = register("TXT", ".txt", "TEXT", compile_txt()).render
+render_compact = register("TXT [COMPACT]", ".txt", "TEXT", compile_compact()).render
+register("NDJSON", ".ndjson", "LINES", compile_ndjson(render_json))
+
+
+def render_many(records: list[dict], render: Render, tf: Time_Format) -> list:
+    """Render a batch of records from one guild.
+    Their times are formatted together first, so rendering each only hits the memo"""
+    tf.format_many(ts for record in records for ts in record_times(record))
+    return [render(record, tf) for record in records]
+
+
+# MIT APasz
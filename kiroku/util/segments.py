@@ -0,0 +1,367 @@
+"""Compression and retention of closed channel log segments"""
+import gzip
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from pathlib import Path as Pathy
+from collections.abc import Iterator
+from typing import BinaryIO
+
+from .. import (
+    SYSLOG,
+    COMPRESS_ALGO,
+    COMPRESS_LEVEL,
+    GUILD_QUOTA_MB,
+    RETENTION_DAYS,
+)
+from ..util.file import Paths, bytes_to_human
+from ..util.manifest import Channel_Manifest, Segment_Entry, channel_of
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+SEGMENT_NAME = re.compile(r"_\(\d+\)\.\d+\.")
+
+GUILD_ID = re.compile(r"_\((\d+)\)$")
+
+SWEEP_SECS = 3600
+"In seconds, how often every guild folder is checked even without a roll"
+
+zip_locks: dict[Pathy, threading.Lock] = {}
+"One change to each cached /get zip at a time, by its path"
+
+
+def _open_gzip(file: Pathy, mode: str) -> BinaryIO:
+    return gzip.open(file, mode)
+
+
+def _open_zstd(file: Pathy, mode: str) -> BinaryIO:
+    if zstandard is None:
+        raise RuntimeError(f"zstandard not installed, can't open {file}")
+    return zstandard.open(file, mode)
+
+
+COMPRESSED = {".gz": _open_gzip, ".zst": _open_zstd}
+"Suffix of compressed segments and how to open them"
+
+
+def guild_of(guild_folder: Pathy) -> int | None:
+    """Guild ID of a log folder, from its <guild>_(<id>) name"""
+    if match := GUILD_ID.search(guild_folder.name):
+        return int(match.group(1))
+    return None
+
+
+def cached_zips(guild_id: int, folder: Pathy = Paths.zips) -> list[Pathy]:
+    """Zips logzip.Log_Zip keeps of a guild between /get requests, one per format"""
+    if not folder.exists():
+        return []
+    return sorted(folder.glob(f"{guild_id}_*.zip"))
+
+
+def drop_zips(guild_id: int, folder: Pathy = Paths.zips) -> int:
+    """Remove a guild's cached zips and their indexes, they're rebuilt when next asked for.
+    Returns the bytes freed"""
+    freed = 0
+    for base in cached_zips(guild_id, folder):
+        with zip_locks.setdefault(base, threading.Lock()):
+            for file in (base, base.with_suffix(".json")):
+                try:
+                    freed += file.stat().st_size
+                    file.unlink()
+                except FileNotFoundError:
+                    pass
+    return freed
+
+
+def is_compressed(file: Pathy) -> bool:
+    return file.suffix in COMPRESSED
+
+
+def open_segment(file: Pathy) -> BinaryIO:
+    """Open a segment for binary reading, decompressing if needed"""
+    opener = COMPRESSED.get(file.suffix)
+    if opener:
+        return opener(file, "rb")
+    return open(file, "rb")
+
+
+def plain_name(file: Pathy) -> str:
+    """Name of a log before it was compressed, what its manifest entry goes by"""
+    return file.with_suffix("").name if is_compressed(file) else file.name
+
+
+def read_ranges(
+    file: Pathy, ranges: list[tuple[int, int | None]], entry: Segment_Entry | None
+) -> Iterator[bytes]:
+    """Stream byte ranges of a log, offsets being before compression.
+    Gzip segments split into members at their sync points are read from the member, others are read through up to the range
+    """
+    for start, end in ranges:
+        member = entry.member(start) if entry and file.suffix == ".gz" else None
+        with open(file, "rb") as raw:
+            if member is not None:
+                raw.seek(member)
+                f = gzip.GzipFile(fileobj=raw, mode="rb")
+            else:
+                f = open_segment(file) if is_compressed(file) else raw
+                f.seek(start)
+            with f:
+                left = None if end is None else end - start
+                while left is None or left > 0:
+                    chunk = f.read(
+                        1024 * 1024 if left is None else min(left, 1024 * 1024)
+                    )
+                    if not chunk:
+                        break
+                    if left is not None:
+                        left -= len(chunk)
+                    yield chunk
+
+
+def is_segment(file: Pathy) -> bool:
+    """Closed segments are named <channel>_(<id>).<seq>.<ext>[.gz|.zst]"""
+    return SEGMENT_NAME.search(file.name) is not None
+
+
+def next_segment(active: Pathy) -> Pathy:
+    """Name the next closed segment for an active log"""
+    seq = 0
+    for file in active.parent.glob(f"{active.stem}.*"):
+        number = file.name[len(active.stem) + 1 :].split(".", 1)[0]
+        if number.isdigit():
+            seq = max(seq, int(number))
+    return active.with_name(f"{active.stem}.{seq + 1:05d}{active.suffix}")
+
+
+def compress(
+    file: Pathy,
+    algo: str = COMPRESS_ALGO,
+    level: int = COMPRESS_LEVEL,
+    keep: bool = False,
+    members: list[int] | None = None,
+):
+    """Compress a segment, the original is removed once the copy is complete unless keep.
+    members= offsets to start a new gzip member at, so reads can start there.
+    They're replaced with where each member starts in the compressed file"""
+    if algo == "ZSTD" and zstandard is None:
+        syslog.warning("zstandard not installed, using GZIP")
+        algo = "GZIP"
+
+    if algo == "GZIP":
+        final = file.with_name(file.name + ".gz")
+    elif algo == "ZSTD":
+        final = file.with_name(file.name + ".zst")
+    else:
+        return file
+
+    part = final.with_name(final.name + ".part")
+    stat = file.stat()
+    with open(file, "rb") as src:
+        if algo == "GZIP" and members:
+            with open(part, "wb") as raw:
+                ends = [*members[1:], None]
+                for number, end in enumerate(ends):
+                    members[number] = raw.tell()
+                    with gzip.GzipFile(
+                        fileobj=raw, mode="wb", compresslevel=level, mtime=0
+                    ) as out:
+                        if end is None:
+                            shutil.copyfileobj(src, out, length=1024 * 1024)
+                        else:
+                            out.write(src.read(end - src.tell()))
+        else:
+            if algo == "GZIP":
+                out = gzip.open(part, "wb", compresslevel=level)
+            else:
+                cctx = zstandard.ZstdCompressor(level=level)
+                out = zstandard.open(part, "wb", cctx=cctx)
+            with out:
+                shutil.copyfileobj(src, out, length=1024 * 1024)
+    # keep the closing time so retention and quota order by age, not by compression
+    os.utime(part, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    part.replace(final)
+    if not keep:
+        file.unlink()
+    syslog.debug("Compressed %s to %s", file.name, bytes_to_human(final.stat().st_size))
+    return final
+
+
+class Segment_Worker:
+    """Compresses closed segments and enforces guild quotas on a background thread"""
+
+    def __init__(
+        self,
+        algo: str = COMPRESS_ALGO,
+        level: int = COMPRESS_LEVEL,
+        quota_mb: float = GUILD_QUOTA_MB,
+        retention_days: float = RETENTION_DAYS,
+    ) -> None:
+        self.algo = algo
+        self.level = level
+        self.quota = int(quota_mb * 1_000_000)
+        self.retention = retention_days * 86400
+        self.queue: queue.Queue[Pathy | None] = queue.Queue()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        """Start the worker thread, existing segments are checked straight away"""
+        if self._thread and self._thread.is_alive():
+            return
+        syslog.info("Starting segment worker")
+        self._thread = threading.Thread(
+            target=self._run, name="segment_worker", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        """Finish queued segments and stop"""
+        if not self._thread:
+            return
+        self.queue.put(None)
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def submit(self, segment: Pathy):
+        """Queue a closed segment, safe to call from any thread"""
+        self.queue.put(segment)
+
+    def _run(self):
+        """Worker thread loop"""
+        self.sweep()
+        last_sweep = time.monotonic()
+        while True:
+            try:
+                segment = self.queue.get(timeout=SWEEP_SECS)
+            except queue.Empty:
+                segment = False
+            if segment is None:
+                break
+            if segment:
+                try:
+                    self.process(segment)
+                except Exception:
+                    syslog.exception("Segment %s", segment)
+            if time.monotonic() - last_sweep >= SWEEP_SECS:
+                self.sweep()
+                last_sweep = time.monotonic()
+        syslog.info("Segment worker stopped")
+
+    def process(self, segment: Pathy):
+        """Compress a single segment then enforce its guild's limits"""
+        if segment.exists() and not is_compressed(segment):
+            self.compress(segment)
+        self.enforce(segment.parent)
+
+    def compress(self, segment: Pathy):
+        """Compress a segment, gzip members start at its manifest's sync points"""
+        channel_id = channel_of(segment)
+        manifest = Channel_Manifest(channel_id) if channel_id else None
+        entry = manifest.read().get(segment.name) if manifest else None
+        members = None
+        whole = entry and entry.syncs and entry.syncs[0][0] == 0
+        if whole and entry.size == segment.stat().st_size:
+            members = [start for start, _, _ in entry.syncs]
+        final = compress(segment, algo=self.algo, level=self.level, members=members)
+        if members and final.suffix == ".gz":
+            entry.members = members
+            manifest.update({segment.name: entry})
+
+    def sweep(self):
+        """Compress anything left over and enforce limits on every guild.
+        Cached zips of guilds whose logs are gone go too"""
+        guilds = set()
+        for guild_folder in Paths.logs.iterdir():
+            if not guild_folder.is_dir():
+                continue
+            guilds.add(guild_of(guild_folder))
+            for file in guild_folder.iterdir():
+                if is_segment(file) and not is_compressed(file):
+                    if file.name.endswith(".part"):
+                        file.unlink()
+                        continue
+                    try:
+                        self.compress(file)
+                    except Exception:
+                        syslog.exception("Compress %s", file)
+            self.enforce(guild_folder)
+
+        if Paths.zips.exists():
+            for base in Paths.zips.glob("*_*.zip"):
+                guild_id = base.name.split("_", 1)[0]
+                if guild_id.isdigit() and int(guild_id) not in guilds:
+                    syslog.info("Removing cached zips of guild %s", guild_id)
+                    drop_zips(int(guild_id))
+
+    def enforce(self, guild_folder: Pathy):
+        """Remove closed segments past retention, then the oldest until under quota.
+        The guild's cached /get zips count towards its quota, they go first.
+        Active logs are never removed"""
+        if not self.quota and not self.retention:
+            return
+
+        files = []
+        total = 0
+        for file in guild_folder.iterdir():
+            if not file.is_file():
+                continue
+            stat = file.stat()
+            total += stat.st_size
+            if is_segment(file):
+                files.append((stat.st_mtime, file.name, stat.st_size, file))
+        files.sort()
+
+        now = time.time()
+        guild_id = guild_of(guild_folder)
+        if guild_id is not None:
+            cached = 0
+            for base in cached_zips(guild_id):
+                for file in (base, base.with_suffix(".json")):
+                    try:
+                        cached += file.stat().st_size
+                    except FileNotFoundError:
+                        pass
+            total += cached
+            expired = self.retention and any(
+                now - mtime > self.retention for mtime, *_ in files
+            )
+            # cheapest to lose, and mustn't keep what retention removes
+            if cached and (expired or (self.quota and total > self.quota)):
+                total -= drop_zips(guild_id)
+                syslog.info("Removed cached zips of %s", guild_folder.name)
+
+        removed = 0
+        for mtime, _, size, file in files:
+            expired = self.retention and now - mtime > self.retention
+            over = self.quota and total > self.quota
+            if not (expired or over):
+                continue
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+
+        if removed:
+            syslog.warning(
+                "Removed %s segments from %s, now %s",
+                removed,
+                guild_folder.name,
+                bytes_to_human(total),
+            )
+        if self.quota and total > self.quota:
+            syslog.warning("%s over quota with only active logs", guild_folder.name)
+
+
+# MIT APasz
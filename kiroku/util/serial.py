@@ -0,0 +1,183 @@
+"""JSON encoding and decoding, using the fastest backend installed.
+msgspec, then orjson, then the standard library"""
+import json as JSON
+import logging
+from typing import Any, TypedDict
+
+from .. import SYSLOG
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+
+# "global" is a keyword, so the functional form
+Author = TypedDict(
+    "Author",
+    {
+        "id": int,
+        "user": str,
+        "global": str | None,
+        "nick": str | None,
+        "display": str,
+        "is_bot": bool,
+        "is_system": bool,
+    },
+    total=False,
+)
+
+
+class Attachment(TypedDict, total=False):
+    id: int
+    media_type: str | None
+    size: int
+    filename: str
+    url: str
+    blob: str
+    "Mirrored copy, relative to Paths.blobs"
+
+
+class Record(TypedDict, total=False):
+    """Raw message record as kept in the archive and database, edits only hold what changed.
+    Typed decoding drops fields not declared here"""
+
+    guild_id: int
+    channel_id: int
+    message_id: int
+    author: Author
+    content: str | None
+    created_at_ts: float
+    edited_at_ts: float | None
+    "None in an edit that removed it"
+    attachments: list[Attachment]
+    embeds: list[dict[str, str | None]]
+    "embed_record, an author or provider may have no name"
+    edit: bool
+
+
+SAMPLE: Record = {
+    "guild_id": 1,
+    "channel_id": 2,
+    "message_id": 3,
+    "author": {
+        "id": 4,
+        "user": "user",
+        "global": None,
+        "nick": None,
+        "display": "user",
+        "is_bot": False,
+        "is_system": False,
+    },
+    "content": None,
+    "created_at_ts": 1.5,
+    "edited_at_ts": None,
+    "attachments": [
+        {
+            "id": 5,
+            "media_type": None,
+            "size": 6,
+            "filename": "file",
+            "url": "https://cdn.discordapp.com/attachments/2/5/file",
+            "blob": "ab/abcdef",
+        }
+    ],
+    "embeds": [{"title": "title", "author": None, "provider": None}],
+    "edit": True,
+}
+"Every field, None wherever one can be, loads_record has to give it back as it was"
+
+
+def _default(obj: Any) -> Any:
+    """Anything the backends don't know, snowflakes and the like are ints already"""
+    if hasattr(obj, "__int__"):
+        return int(obj)
+    return str(obj)
+
+
+if msgspec is not None:
+    BACKEND = "msgspec"
+    _encoder = msgspec.json.Encoder(enc_hook=_default)
+    _decoder = msgspec.json.Decoder()
+    _record_decoder = msgspec.json.Decoder(Record)
+
+    def dumps(obj: Any) -> bytes:
+        return _encoder.encode(obj)
+
+    def dumps_pretty(obj: Any) -> bytes:
+        return msgspec.json.format(_encoder.encode(obj), indent=2)
+
+    def loads(data: bytes | str) -> Any:
+        try:
+            return _decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    def loads_record(data: bytes | str) -> Record:
+        try:
+            return _record_decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+elif orjson is not None:
+    BACKEND = "orjson"
+    _OPTS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default, option=_OPTS)
+
+    def dumps_pretty(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default, option=_OPTS | orjson.OPT_INDENT_2)
+
+    def loads(data: bytes | str) -> Any:
+        return orjson.loads(data)
+
+    loads_record = loads
+
+else:
+    BACKEND = "json"
+
+    def dumps(obj: Any) -> bytes:
+        return JSON.dumps(
+            obj, default=_default, ensure_ascii=False, separators=(",", ":")
+        ).encode("utf-8")
+
+    def dumps_pretty(obj: Any) -> bytes:
+        return JSON.dumps(obj, default=_default, ensure_ascii=False, indent=2).encode(
+            "utf-8"
+        )
+
+    def loads(data: bytes | str) -> Any:
+        return JSON.loads(data)
+
+    loads_record = loads
+
+
+dumps.__doc__ = "Compact JSON as UTF-8 bytes"
+dumps_pretty.__doc__ = "Indented JSON as UTF-8 bytes, the same layout whichever backend"
+loads.__doc__ = "Parse JSON, raises ValueError if it isn't"
+loads_record.__doc__ = "Parse a Record, checked against its schema when the backend can"
+
+if loads_record is not loads:
+    try:
+        checked = loads_record(dumps(SAMPLE)) == SAMPLE
+    except ValueError:
+        checked = False
+    if not checked:
+        # records the schema turns away would be dropped, better unchecked than lost
+        syslog.error("Record schema rejects a valid record, decoding records unchecked")
+        loads_record = loads
+
+syslog.info("JSON backend: %s", BACKEND)
+
+
+# MIT APasz
@@ -0,0 +1,180 @@
+"""Fast local time formatting, with a timezone per guild"""
+import logging
+import math
+from bisect import bisect_right
+from collections.abc import Iterable
+from datetime import datetime, timedelta, timezone, tzinfo
+
+import pytz
+
+from .. import SYSLOG, DATE_FORMAT, TIMEZONE
+from ..util.file import Paths, Read_Write
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+EPOCH = datetime(1970, 1, 1)
+MEMO_SIZE = 4096
+"Formatted minutes (or seconds) kept per timezone before the memo is cleared"
+SUB_MINUTE = ("%f", "%s", "%c", "%T", "%X", "%r", "%-S")
+"Directives that change within a minute, other than %S"
+SECOND = "\ue000"
+"Stands in for %S in the per-minute prefix"
+
+
+def _seconds(delta: timedelta) -> int:
+    return int(delta.total_seconds())
+
+
+def zone_transitions(tz: tzinfo) -> tuple[list[float], list[timezone]]:
+    """UTC times each offset starts, and the offsets, read once from the zone.
+    Zones without a table get their current offset"""
+    times = getattr(tz, "_utc_transition_times", None)
+    infos = getattr(tz, "_transition_info", None)
+    if times and infos:
+        starts = [(time - EPOCH).total_seconds() for time in times]
+        offsets = [
+            timezone(offset, name) if name else timezone(offset)
+            for offset, _, name in infos
+        ]
+        # the first transition is year 1, anything before still uses it
+        starts[0] = -math.inf
+        return starts, offsets
+
+    now = datetime.now(tz)
+    return [-math.inf], [timezone(now.utcoffset(), now.tzname())]
+
+
+class Time_Format:
+    """Formats timestamps in one timezone.
+    Offsets come from a cached transition table, and the text of each local minute
+    is formatted once then has the seconds filled in"""
+
+    def __init__(self, tz: str | tzinfo, fmt: str = DATE_FORMAT) -> None:
+        if isinstance(tz, str):
+            tz = pytz.timezone(tz)
+        self.tz = tz
+        self.name = str(tz)
+        self.fmt = fmt
+        self._starts, self._offsets = zone_transitions(tz)
+        self._secs = [_seconds(offset.utcoffset(None)) for offset in self._offsets]
+
+        body = fmt.replace("%%", "\x01")
+        # %S alone can be filled in per second, anything finer means memoising per second
+        self._per_minute = not any(d in body for d in SUB_MINUTE)
+        if self._per_minute:
+            self._minute_fmt = body.replace("%S", SECOND).replace("\x01", "%%")
+        self._memo: dict[tuple[int, int], tuple[str, ...] | str] = {}
+
+    def __repr__(self) -> str:
+        return f"Time_Format({self.name!r})"
+
+    def transition(self, ts: float) -> int:
+        """Index of the offset in effect at ts"""
+        return bisect_right(self._starts, ts) - 1
+
+    def utcoffset(self, ts: float) -> timedelta:
+        return self._offsets[self.transition(ts)].utcoffset(None)
+
+    def _format(self, second: int, index: int) -> str:
+        offset = self._secs[index]
+        local = second + offset
+        if not self._per_minute:
+            key = (local, index)
+            text = self._memo.get(key)
+            if text is None:
+                text = self._render(local, index, self.fmt)
+                self._remember(key, text)
+            return text
+
+        minute = local - local % 60
+        key = (minute, index)
+        parts = self._memo.get(key)
+        if parts is None:
+            parts = tuple(self._render(minute, index, self._minute_fmt).split(SECOND))
+            self._remember(key, parts)
+        if len(parts) == 1:
+            return parts[0]
+        return f"{local % 60:02d}".join(parts)
+
+    def _render(self, local: int, index: int, fmt: str) -> str:
+        offset = self._offsets[index]
+        time = datetime.fromtimestamp(local - self._secs[index], tz=offset)
+        return time.strftime(fmt)
+
+    def _remember(self, key: tuple[int, int], value: tuple[str, ...] | str):
+        if len(self._memo) >= MEMO_SIZE:
+            self._memo.clear()
+        self._memo[key] = value
+
+    def format(self, ts: int | float) -> str:
+        """Local time of a timestamp"""
+        return self._format(math.floor(ts), self.transition(ts))
+
+    def format_many(self, timestamps: Iterable[int | float]) -> list[str]:
+        """Local times of many timestamps, the transition lookup is skipped
+        while they stay within the same offset, as they do when in order"""
+        out = []
+        index = -1
+        low = high = 0.0
+        starts = self._starts
+        for ts in timestamps:
+            if not low <= ts < high:
+                index = bisect_right(starts, ts) - 1
+                low = starts[index]
+                high = starts[index + 1] if index + 1 < len(starts) else math.inf
+            out.append(self._format(math.floor(ts), index))
+        return out
+
+
+class Zones:
+    """Timezone of each guild, kept in a JSON file"""
+
+    file = Paths.file_zones
+    default = TIMEZONE
+    _guilds: dict[str, str] | None = None
+    _formats: dict[str, Time_Format] = {}
+
+    @classmethod
+    def _load(cls) -> dict[str, str]:
+        if cls._guilds is None:
+            data = Read_Write.read_json(file=cls.file, cache=False, create=True)
+            cls._guilds = data if isinstance(data, dict) else {}
+        return cls._guilds
+
+    @classmethod
+    def format_for_zone(cls, name: str) -> Time_Format:
+        """Shared formatter for a timezone name"""
+        tf = cls._formats.get(name)
+        if tf is None:
+            tf = cls._formats[name] = Time_Format(name)
+        return tf
+
+    @classmethod
+    def zone_name(cls, guild_id: int | None) -> str:
+        if guild_id is None:
+            return cls.default
+        return cls._load().get(str(int(guild_id)), cls.default)
+
+    @classmethod
+    def get(cls, guild_id: int | None) -> Time_Format:
+        """Formatter for a guild, the default timezone if it hasn't set one"""
+        return cls.format_for_zone(cls.zone_name(guild_id))
+
+    @classmethod
+    def set(cls, guild_id: int, name: str | None) -> str:
+        """Set a guild's timezone, None to go back to the default.
+        Raises pytz.UnknownTimeZoneError for unknown names. Returns the zone in use"""
+        guilds = cls._load()
+        key = str(int(guild_id))
+        if name is None:
+            guilds.pop(key, None)
+        else:
+            name = str(pytz.timezone(name))
+            guilds[key] = name
+        Read_Write.write_json(data=guilds, file=cls.file, sort=True)
+        return cls.zone_name(guild_id)
+
+
+# MIT APasz
@@ -0,0 +1,99 @@
+"""Getting exports into Discord, compressed and split to fit the upload limit"""
+import asyncio
+import logging
+import zipfile
+from collections.abc import Awaitable, Callable
+from pathlib import Path as Pathy
+
+import hikari
+
+from .. import SYSLOG, COMPRESS_LEVEL, EXPORT_COMPRESS, UPLOAD_LIMIT_MB
+from ..util.file import bytes_to_human
+from ..util.segments import compress
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+TIER_LIMIT_MB = {
+    hikari.GuildPremiumTier.TIER_2: 50,
+    hikari.GuildPremiumTier.TIER_3: 100,
+}
+"Upload limits boosts raise a guild to"
+HEADROOM = 64 * 1024
+"Bytes left under the limit for the rest of the request"
+
+Send = Callable[..., Awaitable]
+
+
+def upload_limit(guild: hikari.Guild | None) -> int:
+    """Largest file a guild will take, in bytes"""
+    limit_mb = UPLOAD_LIMIT_MB
+    if guild is not None:
+        limit_mb = max(limit_mb, TIER_LIMIT_MB.get(guild.premium_tier, 0))
+    return int(limit_mb * 1024 * 1024) - HEADROOM
+
+
+def pack(
+    file: Pathy, algo: str = EXPORT_COMPRESS, level: int = COMPRESS_LEVEL
+) -> Pathy:
+    """Compressed copy of an export, or the export itself if it's already a zip or algo is NONE"""
+    if algo == "NONE" or file.suffix == ".zip":
+        return file
+    if algo != "ZIP":
+        return compress(file, algo=algo, level=level, keep=True)
+
+    final = file.with_name(file.name + ".zip")
+    part = final.with_name(final.name + ".part")
+    # deflate only goes to 9
+    with zipfile.ZipFile(
+        part, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=min(level, 9)
+    ) as zf:
+        zf.write(file, arcname=file.name)
+    part.replace(final)
+    return final
+
+
+def split(file: Pathy, size: int) -> list[Pathy]:
+    """Cut a file into parts of at most size bytes, named .001 .002 and so on.
+    A file that fits is left as it is"""
+    if file.stat().st_size <= size:
+        return [file]
+    parts = []
+    with open(file, "rb") as src:
+        while chunk := src.read(size):
+            part = file.with_name(f"{file.name}.{len(parts) + 1:03d}")
+            part.write_bytes(chunk)
+            parts.append(part)
+    return parts
+
+
+async def send_file(
+    send: Send, file: Pathy, content: str, guild: hikari.Guild | None = None
+):
+    """Upload an export with send(content, attachment=...), compressed and in parts if too big.
+    Compressing and splitting happen off the event loop, what they make is removed afterwards
+    """
+    packed = await asyncio.to_thread(pack, file)
+    parts = await asyncio.to_thread(split, packed, upload_limit(guild))
+    syslog.debug(
+        "Uploading %s as %s parts, %s",
+        file.name,
+        len(parts),
+        bytes_to_human(packed.stat().st_size),
+    )
+    try:
+        if len(parts) == 1:
+            await send(content, attachment=parts[0])
+            return
+        for number, part in enumerate(parts, 1):
+            text = f"{content} | Part {number}/{len(parts)}"
+            if number == len(parts):
+                text += f"\nJoin the parts in order to get {packed.name}"
+            await send(text, attachment=part)
+    finally:
+        for made in {packed, *parts} - {file}:
+            made.unlink(missing_ok=True)
+
+
+# MIT APasz
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass
+
+from .. import (
+    SYSLOG,
+    WRITE_QUEUE_SIZE,
+    WRITE_BATCH_SIZE,
+    WRITE_FLUSH_SECS,
+    WRITE_FSYNC,
+    WRITE_BACKPRESSURE,
+)
+from ..util.database import Message_DB
+from ..util.logs import Channel_Log, Log_Registry
+from ..util.metrics import EVENT_TO_DISK
+
+print(__name__)
+
+syslog = logging.getLogger(SYSLOG)
+
+
+@dataclass(slots=True)
+class Archive_Record:
+    """A single message waiting to be written"""
+
+    log: Channel_Log
+    created: float
+    record: dict
+    session: int | None
+    received: float | None = None
+    "Monotonic time the event was handled, for latency"
+
+
+class Archive_Writer:
+    """Write-behind archive writer, keeps file IO off the event loop.
+    Listeners enqueue records, a writer thread drains them in batches and groups the writes per channel file
+    """
+
+    def __init__(
+        self,
+        logs: Log_Registry,
+        database: Message_DB | None = None,
+        size: int = WRITE_QUEUE_SIZE,
+        batch: int = WRITE_BATCH_SIZE,
+        flush_secs: float = WRITE_FLUSH_SECS,
+        fsync: str = WRITE_FSYNC,
+        backpressure: str = WRITE_BACKPRESSURE,
+    ) -> None:
+        self.logs = logs
+        self.database = database
+        self.queue: queue.Queue[Archive_Record | None] = queue.Queue(maxsize=size)
+        self.batch = max(1, batch)
+        self.flush_secs = max(0.0, flush_secs)
+        self.fsync = fsync == "FLUSH"
+        if backpressure not in ("WAIT", "DROP"):
+            syslog.warning("Unknown backpressure %s, using WAIT", backpressure)
+            backpressure = "WAIT"
+        self.backpressure = backpressure
+        self.dropped = 0
+        self.written = 0
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        """Start the writer thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        syslog.info("Starting archive writer")
+        self._thread = threading.Thread(
+            target=self._run, name="archive_writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        """Flush everything queued and stop the writer thread"""
+        if not self._thread:
+            return
+        syslog.info("Stopping archive writer, %s queued", self.queue.qsize())
+        self.queue.put(None)
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+    async def put(
+        self,
+        log: Channel_Log,
+        record: dict,
+        created: float | None = None,
+        session: int | None = None,
+        received: float | None = None,
+    ):
+        """Queue a message record for log, applying backpressure if the queue is full.
+        session= database session the message was seen live in, None if not a new message.
+        received= time.monotonic() when the event was handled, to time it to disk
+        """
+        record = Archive_Record(
+            log=log,
+            created=created if created is not None else time.time(),
+            record=record,
+            session=session,
+            received=received,
+        )
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            pass
+
+        if self.backpressure == "DROP":
+            self.dropped += 1
+            if self.database:
+                # the dropped message isn't stored, live coverage can't run across it
+                self.database.reset_live()
+            if self.dropped % 100 == 1:
+                syslog.warning("Archive queue full, %s records dropped", self.dropped)
+            return False
+
+        syslog.debug("Archive queue full, waiting")
+        await asyncio.to_thread(self.queue.put, record)
+        return True
+
+    def _drain(self) -> tuple[list[Archive_Record], bool]:
+        """Collect a batch, waits at most flush_secs after the first record"""
+        while True:
+            try:
+                first = self.queue.get(timeout=self.logs.idle_secs / 2)
+                break
+            except queue.Empty:
+                self.logs.sweep()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.flush_secs
+        while len(batch) < self.batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    record = self.queue.get(timeout=remaining)
+                else:
+                    record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is None:
+                return batch, True
+            batch.append(record)
+        return batch, False
+
+    def _run(self):
+        """Writer thread loop"""
+        stop = False
+        while not stop:
+            batch, stop = self._drain()
+            if batch:
+                self._write(batch)
+
+        # anything queued after the stop signal still gets written
+        leftover = []
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not None:
+                leftover.append(record)
+        if leftover:
+            self._write(leftover)
+        self.logs.close_all()
+        syslog.info("Archive writer stopped, %s written", self.written)
+
+    def _write(self, batch: list[Archive_Record]):
+        """Write a batch, grouped so each file is flushed once"""
+        groups: dict[Channel_Log, list[tuple[float, dict]]] = {}
+        for record in batch:
+            groups.setdefault(record.log, []).append((record.created, record.record))
+
+        for log, records in groups.items():
+            try:
+                log.write(records=records, fsync=self.fsync)
+            except Exception:
+                syslog.exception("Archive write failed: %s", log.path)
+        self.written += len(batch)
+        now = time.monotonic()
+        for record in batch:
+            if record.received is not None:
+                EVENT_TO_DISK.observe(now - record.received)
+
+        if self.database:
+            try:
+                sessions: dict[int | None, list[dict]] = {}
+                for record in batch:
+                    sessions.setdefault(record.session, []).append(record.record)
+                for session, records in sessions.items():
+                    self.database.add(records, session=session)
+            except Exception:
+                syslog.exception("Database write failed")
+                self.database.reset_live()
+        self.logs.sweep()
+
+
+# MIT APasz